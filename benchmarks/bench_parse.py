@@ -0,0 +1,254 @@
+"""Measure rows per second and peak RSS of the parsing and output stages.
+
+Each stage runs in its own process so that its peak RSS is not mixed with the
+other stages. The results are written as JSON to compare across versions.
+
+usage: python bench_parse.py -s ActivitiesCache.db [-r RESULTS] [--stage STAGE] [--repeat N]
+       python bench_parse.py -n 10000 [-r RESULTS]
+"""
+import os
+import sys
+import time
+import ujson
+import sqlite3
+import platform
+import tempfile
+import argparse
+import importlib.util
+import multiprocessing
+sys.path.append("..")
+from winactivities.activities import ActivitiesDb
+from winactivities.helpers import CustomStringFormatter, compile_template
+from winactivities.output import OutputSink
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+SCRIPT_LOCATION = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "scripts", "winactivities2json.py"
+)
+DEFAULT_TEMPLATE = "{StartTime} - {AppId[0][application]} ({Payload[activeDurationSeconds]}s) {ETag}"
+
+
+def bench_iter_activities(source, template):
+    count = 0
+    with ActivitiesDb(source) as activities_db:
+        for record in activities_db.iter_activities():
+            count += 1
+    return count
+
+
+def bench_iter_records(source, template):
+    count = 0
+    with ActivitiesDb(source) as activities_db:
+        for record in activities_db.iter_records():
+            count += 1
+    return count
+
+
+def bench_as_ordered_dict(source, template):
+    count = 0
+    with ActivitiesDb(source) as activities_db:
+        for record in activities_db.iter_activities():
+            record.as_ordered_dict()
+            count += 1
+    return count
+
+
+def bench_formatter(source, template):
+    count = 0
+    formatter = CustomStringFormatter()
+    with ActivitiesDb(source) as activities_db:
+        for record in activities_db.iter_activities():
+            formatter.format(template, **record.as_ordered_dict())
+            count += 1
+    return count
+
+
+def bench_compiled_template(source, template):
+    count = 0
+    compiled_template = compile_template(template)
+    with ActivitiesDb(source) as activities_db:
+        for record in activities_db.iter_activities():
+            compiled_template.render(record.as_ordered_dict())
+            count += 1
+    return count
+
+
+def bench_parse_file(source, template):
+    spec = importlib.util.spec_from_file_location("winactivities2json", SCRIPT_LOCATION)
+    script = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(script)
+
+    options = script.get_arguments().parse_args(["-s", source])
+    options.source = source
+    with OutputSink(os.devnull) as output_sink:
+        script.parse_file(options, None, output_sink, None)
+    return output_sink.records_written
+
+
+STAGES = {
+    "iter_activities": bench_iter_activities,
+    "iter_records": bench_iter_records,
+    "as_ordered_dict": bench_as_ordered_dict,
+    "formatter": bench_formatter,
+    "compiled_template": bench_compiled_template,
+    "parse_file": bench_parse_file,
+}
+
+
+def get_peak_rss():
+    """Get the peak RSS of this process in bytes, None if it is not available."""
+    if resource is None:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak_rss
+    # kilobytes on Linux
+    return peak_rss * 1024
+
+
+def _run_stage(job):
+    stage, source, template = job
+    start_time = time.perf_counter()
+    rows = STAGES[stage](source, template)
+    seconds = time.perf_counter() - start_time
+    return rows, seconds, get_peak_rss()
+
+
+def run_stage(stage, source, template, repeat):
+    """Run a stage in fresh processes and keep the fastest run.
+
+    Returns:
+        (dict): The stage result.
+    """
+    context = multiprocessing.get_context("spawn")
+    best = None
+    for _ in range(repeat):
+        with context.Pool(1) as pool:
+            rows, seconds, peak_rss = pool.apply(_run_stage, ((stage, source, template),))
+        if best is None or seconds < best[1]:
+            best = (rows, seconds, peak_rss)
+
+    rows, seconds, peak_rss = best
+    return {
+        "stage": stage,
+        "rows": rows,
+        "seconds": round(seconds, 4),
+        "rows_per_second": round(rows / seconds, 1) if seconds else None,
+        "peak_rss_bytes": peak_rss
+    }
+
+
+def get_arguments():
+    arguments = argparse.ArgumentParser(
+        description="Benchmark the parsing and output stages on an activities database."
+    )
+    arguments.add_argument(
+        "-s", "--source",
+        dest="source",
+        action="store",
+        required=False,
+        default=None,
+        help="The activities database to benchmark."
+    )
+    arguments.add_argument(
+        "-n", "--rows",
+        dest="rows",
+        action="store",
+        type=int,
+        required=False,
+        default=None,
+        help="Generate a synthetic database with this many activities instead of -s."
+    )
+    arguments.add_argument(
+        "-r", "--results",
+        dest="results",
+        action="store",
+        required=False,
+        default=None,
+        help="Write the results as JSON to this file. (default: stdout)"
+    )
+    arguments.add_argument(
+        "--stage",
+        dest="stages",
+        action="append",
+        required=False,
+        default=None,
+        choices=sorted(STAGES.keys()),
+        help="Only run this stage. Can be used multiple times. (default: all)"
+    )
+    arguments.add_argument(
+        "--repeat",
+        dest="repeat",
+        action="store",
+        type=int,
+        required=False,
+        default=1,
+        help="Runs per stage, the fastest is reported. (default: 1)"
+    )
+    arguments.add_argument(
+        "-o", "--output_template",
+        dest="output_template",
+        action="store",
+        required=False,
+        default=DEFAULT_TEMPLATE,
+        help="Output template for the formatter stages."
+    )
+    return arguments
+
+
+def main():
+    arguments = get_arguments()
+    options = arguments.parse_args()
+    if not (options.source or options.rows):
+        arguments.error("-s or -n is required")
+
+    source = options.source
+    temp_location = None
+    if not source:
+        from generate_activities import generate
+
+        temp_handle, temp_location = tempfile.mkstemp(suffix=".db")
+        os.close(temp_handle)
+        generate(temp_location, options.rows)
+        source = temp_location
+
+    try:
+        results = []
+        for stage in options.stages or STAGES.keys():
+            result = run_stage(stage, source, options.output_template, options.repeat)
+            sys.stderr.write("{:<18} {:>10} rows {:>12.0f} rows/s {:>8} MiB peak\n".format(
+                result["stage"], result["rows"], result["rows_per_second"] or 0,
+                (result["peak_rss_bytes"] or 0) // (1024 * 1024)
+            ))
+            results.append(result)
+
+        report = {
+            "source": os.path.abspath(source) if options.source else None,
+            "generated_rows": options.rows if not options.source else None,
+            "database_bytes": os.path.getsize(source),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "results": results
+        }
+    finally:
+        if temp_location:
+            os.remove(temp_location)
+
+    output = ujson.dumps(report, indent=2)
+    if options.results:
+        with open(options.results, "w") as fh:
+            fh.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
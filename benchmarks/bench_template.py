@@ -0,0 +1,79 @@
+"""Compare CustomStringFormatter with CompiledTemplate on a README style record.
+
+usage: python bench_template.py [-n ITERATIONS] [-o OUTPUT_TEMPLATE]
+"""
+import sys
+import timeit
+import argparse
+sys.path.append("..")
+from winactivities.helpers import CustomStringFormatter, compile_template
+
+RECORD = {
+    "_rowid": 115,
+    "Id": "c6fbf27c49fb82315155669f8329c995",
+    "AppId": [{
+        "application": "{1AC14E77-02E7-4E5D-B744-2EB1AE5198B7}\\WindowsPowerShell\\v1.0\\powershell.exe",
+        "platform": "windows_win32"
+    }, {
+        "application": "",
+        "platform": "alternateId"
+    }],
+    "ActivityType": 6,
+    "StartTime": "2018-07-13 17:01:36",
+    "EndTime": "2018-07-13 17:13:28",
+    "Payload": {
+        "type": "UserEngaged",
+        "activeDurationSeconds": 142
+    },
+    "ETag": 687,
+    "_user": "mpowers",
+    "_cpd_location": "L.mpowers"
+}
+DEFAULT_TEMPLATE = "{_user}: {StartTime} - {AppId[0][application]} ({Payload[activeDurationSeconds]}s) {Missing}"
+
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description="Benchmark output template rendering."
+    )
+    arguments.add_argument(
+        "-n", "--iterations",
+        dest="iterations",
+        action="store",
+        type=int,
+        default=200000,
+        help="Records to format per run. (default: 200000)"
+    )
+    arguments.add_argument(
+        "-o", "--output_template",
+        dest="output_template",
+        action="store",
+        default=DEFAULT_TEMPLATE,
+        help="Output template format."
+    )
+    options = arguments.parse_args()
+
+    formatter = CustomStringFormatter()
+    template = compile_template(options.output_template)
+    assert formatter.format(options.output_template, **RECORD) == template.render(RECORD)
+
+    formatter_time = min(timeit.repeat(
+        lambda: formatter.format(options.output_template, **RECORD),
+        number=options.iterations, repeat=3
+    ))
+    template_time = min(timeit.repeat(
+        lambda: template.render(RECORD),
+        number=options.iterations, repeat=3
+    ))
+
+    print("CustomStringFormatter.format: {:.0f} records/s".format(
+        options.iterations / formatter_time
+    ))
+    print("CompiledTemplate.render:      {:.0f} records/s".format(
+        options.iterations / template_time
+    ))
+    print("speedup: {:.2f}x".format(formatter_time / template_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Run a --source_dir --dump_db --output_dir batch of many generated sources with a low
+open file limit, and check that every source was written. The files of a source are
+closed when it is done, so the open files do not grow with the number of sources.
+
+usage: python check_sharded_sources.py [--sources 40] [--rows 200] [--open_files 64]
+"""
+import os
+import sys
+import ujson
+import shutil
+import tempfile
+import argparse
+import subprocess
+sys.path.append("..")
+from winactivities.activities import ActivitiesDb
+from generate_activities import generate
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+SCRIPT_LOCATION = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "scripts", "winactivities2json.py"
+)
+
+
+def count_records(source):
+    with ActivitiesDb(source) as activities_db:
+        return sum(1 for record in activities_db.iter_records())
+
+
+def check(sources, rows, open_files, compression):
+    """Generate the sources, run the batch and compare its manifest to the databases.
+
+    Returns:
+        (list): The problems found, empty if the run is good.
+    """
+    location = tempfile.mkdtemp(prefix="win-activities-sharded-")
+    try:
+        source_dir = os.path.join(location, "sources")
+        expected = {}
+        for index in range(sources):
+            host_location = os.path.join(source_dir, "host{:03d}".format(index))
+            os.makedirs(host_location)
+            source = os.path.join(host_location, "ActivitiesCache.db")
+            generate(source, rows, seed=index)
+            expected[source] = count_records(source)
+
+        def limit_open_files():
+            resource.setrlimit(resource.RLIMIT_NOFILE, (open_files, open_files))
+
+        output_dir = os.path.join(location, "output")
+        process = subprocess.run(
+            [
+                sys.executable, SCRIPT_LOCATION, "--source_dir", source_dir, "--dump_db",
+                "--output_dir", output_dir, "--compression", compression
+            ],
+            stderr=subprocess.PIPE,
+            preexec_fn=limit_open_files if resource is not None else None,
+            env=dict(os.environ, PYTHONPATH=os.path.join(os.path.dirname(SCRIPT_LOCATION), ".."))
+        )
+
+        problems = []
+        if process.returncode != 0:
+            problems.append("exit status {}: {}".format(
+                process.returncode, process.stderr.decode("utf-8", "replace")[-2000:]
+            ))
+
+        with open(os.path.join(output_dir, "manifest.json"), "r") as fh:
+            manifest = ujson.load(fh)
+
+        written = {}
+        for shard in manifest["shards"]:
+            written[shard["source"]] = written.get(shard["source"], 0) + shard["rows"]
+        for source, records in sorted(expected.items()):
+            if written.get(source) != records:
+                problems.append("{}: {} records, {} written".format(
+                    source, records, written.get(source)
+                ))
+        return problems
+    finally:
+        shutil.rmtree(location)
+
+
+def get_arguments():
+    arguments = argparse.ArgumentParser(
+        description="Check a sharded batch of many sources under a low open file limit."
+    )
+    arguments.add_argument(
+        "--sources",
+        dest="sources",
+        action="store",
+        type=int,
+        required=False,
+        default=40,
+        help="Number of sources to generate. (default: 40)"
+    )
+    arguments.add_argument(
+        "--rows",
+        dest="rows",
+        action="store",
+        type=int,
+        required=False,
+        default=200,
+        help="Activities per source. (default: 200)"
+    )
+    arguments.add_argument(
+        "--open_files",
+        dest="open_files",
+        action="store",
+        type=int,
+        required=False,
+        default=64,
+        help="The open file limit of the run. (default: 64)"
+    )
+    arguments.add_argument(
+        "--compression",
+        dest="compression",
+        action="store",
+        required=False,
+        default="gzip",
+        help="The --compression of the run. (default: gzip)"
+    )
+    return arguments
+
+
+def main():
+    options = get_arguments().parse_args()
+    problems = check(options.sources, options.rows, options.open_files, options.compression)
+    for problem in problems:
+        sys.stderr.write(problem + "\n")
+    if problems:
+        sys.exit(1)
+    sys.stdout.write("ok: {} sources\n".format(options.sources))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""Generate a synthetic ActivitiesCache.db with the tables and views of ACTIVITIES_SCHEMA.
+
+Activities get AppId and Payload JSON like Windows 10 writes them, and every
+seventh activity a clipboard blob. The same seed generates the same database.
+
+usage: python generate_activities.py -o ActivitiesCache.db [-n ROWS] [--seed SEED]
+"""
+import os
+import sys
+import uuid
+import ujson
+import base64
+import random
+import sqlite3
+import logging
+import argparse
+sys.path.append("..")
+from winactivities.activities import ACTIVITIES_SCHEMA
+
+SCHEMA_SQL = """
+CREATE TABLE Activity (
+    Id GUID PRIMARY KEY NOT NULL, AppId TEXT NOT NULL, PackageIdHash TEXT, AppActivityId TEXT,
+    ActivityType INT NOT NULL, ActivityStatus INT NOT NULL, ParentActivityId GUID, Tag TEXT,
+    "Group" TEXT, MatchId TEXT, LastModifiedTime DATETIME NOT NULL, ExpirationTime DATETIME NOT NULL,
+    Payload BLOB, Priority INT, IsLocalOnly INT, PlatformDeviceId TEXT, CreatedInCloud DATETIME,
+    StartTime DATETIME, EndTime DATETIME, LastModifiedOnClient DATETIME, GroupAppActivityId TEXT,
+    ClipboardPayload BLOB, EnterpriseId TEXT, OriginalPayload BLOB,
+    OriginalLastModifiedOnClient DATETIME, ETag INT NOT NULL
+);
+CREATE TABLE Activity_PackageId (
+    ActivityId GUID NOT NULL, Platform TEXT NOT NULL, PackageName TEXT NOT NULL,
+    ExpirationTime DATETIME NOT NULL
+);
+CREATE TABLE ActivityAssetCache (
+    ResourceId INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, AppActivityId TEXT NOT NULL,
+    AssetHash TEXT NOT NULL, TimeToLive DATETIME NOT NULL, AssetUri TEXT, AssetId TEXT,
+    AssetKey TEXT, Contents BLOB
+);
+CREATE TABLE ActivityOperation (
+    OperationOrder INTEGER PRIMARY KEY ASC NOT NULL, Id GUID NOT NULL, OperationType INT NOT NULL,
+    AppId TEXT NOT NULL, PackageIdHash TEXT, AppActivityId TEXT, ActivityType INT NOT NULL,
+    ParentActivityId GUID, Tag TEXT, "Group" TEXT, MatchId TEXT, LastModifiedTime DATETIME NOT NULL,
+    ExpirationTime DATETIME NOT NULL, Payload BLOB, Priority INT, CreatedTime DATETIME,
+    Attachments TEXT, PlatformDeviceId TEXT, CreatedInCloud DATETIME, StartTime DATETIME,
+    EndTime DATETIME, LastModifiedOnClient DATETIME, CorrelationVector TEXT,
+    GroupAppActivityId TEXT, ClipboardPayload BLOB, EnterpriseId TEXT, OriginalPayload BLOB,
+    OriginalLastModifiedOnClient DATETIME, ETag INT NOT NULL
+);
+CREATE TABLE AppSettings (
+    AppId TEXT PRIMARY KEY NOT NULL, SettingsPropertyBag BLOB, AppTitle TEXT, Logo4141 TEXT
+);
+CREATE TABLE ManualSequence (Key TEXT PRIMARY KEY NOT NULL, Value INT NOT NULL);
+CREATE TABLE Metadata (Key TEXT PRIMARY KEY NOT NULL, Value TEXT);
+CREATE VIEW SmartLookup AS
+    SELECT ETag IN (SELECT ETag FROM ActivityOperation) AS IsInUploadQueue, Activity.*
+    FROM Activity;
+"""
+
+APPLICATIONS = [
+    ("{1AC14E77-02E7-4E5D-B744-2EB1AE5198B7}\\cmd.exe", "Command Prompt"),
+    ("{1AC14E77-02E7-4E5D-B744-2EB1AE5198B7}\\WindowsPowerShell\\v1.0\\powershell.exe", "Windows PowerShell"),
+    ("{1AC14E77-02E7-4E5D-B744-2EB1AE5198B7}\\notepad.exe", "Notepad"),
+    ("{6D809377-6AF0-444B-8957-A3773F02200E}\\Google\\Chrome\\Application\\chrome.exe", "Google Chrome"),
+    ("{7C5A40EF-A0FB-4BFC-874A-C0F2E0B9FA8E}\\Microsoft Office\\root\\Office16\\WINWORD.EXE", "Word"),
+    ("Microsoft.Windows.Explorer", "File Explorer"),
+    ("Microsoft.MicrosoftEdge_8wekyb3d8bbwe!MicrosoftEdge", "Microsoft Edge"),
+]
+DOCUMENTS = [
+    "C:\\Users\\mpowers\\Documents\\report.docx",
+    "C:\\Users\\mpowers\\Desktop\\notes.txt",
+    "https://github.com/forensicmatt/RustyUsn",
+    "C:\\Windows\\System32\\drivers\\etc\\hosts",
+]
+TIME_ZONES = ["America/Los_Angeles", "America/New_York", "Europe/London"]
+FIRST_START_TIME = 1531500000
+INSERT_BATCH_SIZE = 50000
+
+
+def get_app_id(application):
+    return ujson.dumps([
+        {"application": application, "platform": "windows_win32"},
+        {"application": application, "platform": "packageId"},
+        {"application": "", "platform": "alternateId"}
+    ])
+
+
+def get_payload(rng, activity_type, application, display_name):
+    if activity_type == 6:
+        payload = {
+            "type": "UserEngaged",
+            "reportingApp": "ShellActivityMonitor",
+            "activeDurationSeconds": rng.randint(1, 3600),
+            "shellContentDescription": {
+                "MergedGap": rng.randint(1, 600)
+            },
+            "userTimezone": rng.choice(TIME_ZONES)
+        }
+    else:
+        document = rng.choice(DOCUMENTS)
+        payload = {
+            "displayText": os.path.basename(document),
+            "description": document,
+            "appDisplayName": display_name,
+            "activationUri": "ms-shellactivity:",
+            "contentUri": "file:///{}".format(document.replace("\\", "/")),
+            "backgroundColor": "black"
+        }
+    return ujson.dumps(payload).encode("utf-8")
+
+
+def get_clipboard_payload(rng):
+    text = "".join(rng.choice("abcdefghij klmnopqrstuvwxyz\n") for _ in range(rng.randint(16, 4096)))
+    return ujson.dumps([{
+        "content": base64.b64encode(text.encode("utf-16-le")).decode("ascii"),
+        "formatName": "Text"
+    }]).encode("utf-8")
+
+
+def iter_activity_rows(rng, rows):
+    device_id = base64.b64encode(bytes(rng.getrandbits(8) for _ in range(32))).decode("ascii")
+    for index in range(rows):
+        application, display_name = rng.choice(APPLICATIONS)
+        activity_type = rng.choice([5, 5, 6, 6, 6, 10, 16])
+        start_time = FIRST_START_TIME + index * 37 + rng.randint(0, 30)
+        end_time = 0
+        if activity_type == 6:
+            end_time = start_time + rng.randint(1, 3600)
+
+        clipboard_payload = None
+        if activity_type in (10, 16) and index % 7 == 0:
+            clipboard_payload = get_clipboard_payload(rng)
+
+        yield (
+            uuid.UUID(int=rng.getrandbits(128)).bytes, get_app_id(application),
+            "ecKlJnRK4ij2kcfb6Jm5OtsifKZhc8lrSqsoC7mpRwI=", str(uuid.UUID(int=rng.getrandbits(128))),
+            activity_type, 1, bytes(16), None, None, None,
+            start_time + 60, start_time + 30 * 86400,
+            get_payload(rng, activity_type, application, display_name), 3, 0,
+            device_id, 0, start_time, end_time, start_time + 60, "", clipboard_payload,
+            "", None, 0, index + 1
+        )
+
+
+def iter_batches(iterable, batch_size=INSERT_BATCH_SIZE):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate(location, rows, seed=0):
+    """Create a synthetic activities database.
+
+    Params:
+        location (unicode): The database file to create, replaced if it exists.
+        rows (int): The number of activities.
+        seed (int): The random seed.
+    """
+    if os.path.exists(location):
+        os.remove(location)
+
+    rng = random.Random(seed)
+    connection = sqlite3.connect(location)
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.executescript(SCHEMA_SQL)
+
+    created = set(
+        name for name, in connection.execute("SELECT name FROM sqlite_master")
+    )
+    missing = set(ACTIVITIES_SCHEMA["tables"] + ACTIVITIES_SCHEMA["views"]) - created
+    if missing:
+        raise Exception("Schema is missing: {}".format(", ".join(sorted(missing))))
+
+    operation_interval = 10
+    for batch in iter_batches(iter_activity_rows(rng, rows)):
+        with connection:
+            connection.executemany(
+                "INSERT INTO Activity VALUES ({})".format(",".join("?" * 26)), batch
+            )
+            connection.executemany(
+                "INSERT INTO Activity_PackageId VALUES (?, ?, ?, ?)", [
+                    (row[0], platform["platform"], platform["application"], row[11])
+                    for row in batch for platform in ujson.loads(row[1])[:2]
+                ]
+            )
+            connection.executemany(
+                "INSERT INTO ActivityOperation (Id, OperationType, AppId, ActivityType, "
+                "LastModifiedTime, ExpirationTime, Payload, CreatedTime, StartTime, EndTime, "
+                "ClipboardPayload, ETag) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+                    (row[0], 1, row[1], row[4], row[10], row[11], row[12], row[17], row[17],
+                     row[18], row[21], row[25])
+                    for row in batch if row[25] % operation_interval == 0
+                ]
+            )
+
+    with connection:
+        connection.executemany(
+            "INSERT INTO AppSettings VALUES (?, ?, ?, ?)", [
+                (get_app_id(application), None, display_name, None)
+                for application, display_name in APPLICATIONS
+            ]
+        )
+        connection.executemany(
+            "INSERT INTO ActivityAssetCache (AppActivityId, AssetHash, TimeToLive, AssetUri) "
+            "VALUES (?, ?, ?, ?)", [
+                ("ECB32AF3-1440-4086-94E3-5311F97F89C4", "hash{}".format(index), FIRST_START_TIME,
+                 "ms-appdata:///local/asset{}.png".format(index))
+                for index in range(32)
+            ]
+        )
+        connection.execute("INSERT INTO ManualSequence VALUES ('Activity', ?)", (rows,))
+        connection.execute("INSERT INTO Metadata VALUES ('SchemaVersion', '23')")
+
+    connection.close()
+    logging.info("Generated {} activities in {}".format(rows, location))
+
+
+def main():
+    arguments = argparse.ArgumentParser(
+        description="Generate a synthetic ActivitiesCache.db."
+    )
+    arguments.add_argument(
+        "-o", "--output",
+        dest="output",
+        action="store",
+        required=True,
+        help="The database to create."
+    )
+    arguments.add_argument(
+        "-n", "--rows",
+        dest="rows",
+        action="store",
+        type=int,
+        default=10000,
+        help="Number of activities, such as 10000, 1000000 or 10000000. (default: 10000)"
+    )
+    arguments.add_argument(
+        "--seed",
+        dest="seed",
+        action="store",
+        type=int,
+        default=0,
+        help="Random seed. (default: 0)"
+    )
+    options = arguments.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    generate(options.output, options.rows, options.seed)
+
+
+if __name__ == "__main__":
+    main()
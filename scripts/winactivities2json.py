@@ -1,16 +1,32 @@
+import os
 import re
 import sys
-import ujson
+import copy
+import time
+import tempfile
+import traceback
+import multiprocessing
 import pytsk3
 import logging
+import cProfile
 import argparse
 sys.path.append("..")
-from winactivities.activities import ActivitiesDb
-from winactivities.helpers import CustomStringFormatter
-from winactivities.logical import VolumeProcessor
+from winactivities.activities import ActivitiesDb, ActivityFilter, iter_activity_versions
+from winactivities.helpers import compile_template, datetime_encode_1970
+from winactivities.logical import VolumeProcessor, DEFAULT_MEMORY_LIMIT
+from winactivities.output import OutputSink, format_record, format_row, DEFAULT_BUFFER_SIZE
+from winactivities.columnar import ColumnarSink, COLUMNAR_FORMATS, DEFAULT_BATCH_SIZE
+from winactivities.casestore import CaseStoreSink
+from winactivities.sharded import ShardedSink, COMPRESSIONS, DEFAULT_SHARD_SIZE, DEFAULT_COMPRESSION_THREADS
+from winactivities.state import StateFile
+from winactivities.stats import Stats, RecordTimer
+from winactivities.timeline import SORT_FIELDS, merge_sorted, iter_external_sorted, iter_keyed_records
+from winactivities.summary import SUMMARIES, iter_keyed_rows, iter_merged_rows
 
 VALID_DEBUG_LEVELS = ["ERROR", "WARN", "INFO", "DEBUG"]
 __VERSION__ = "0.0.1"
+# the --stats source of the output of a merged --sort or --summary batch
+BATCH_STATS_SOURCE = "batch"
 
 
 def set_debug_level(debug_level):
@@ -22,6 +38,10 @@ def set_debug_level(debug_level):
         raise (Exception("{} is not a valid debug level.".format(debug_level)))
 
 
+def is_logical_volume(source):
+    return re.match('\\\\\\\.\\\[a-zA-Z]:', source)
+
+
 def get_arguments():
     usage = u"""Interface to parse Windows Timeline - ActivitiesCache.db.
 Run this tool on the database file, or on a logical volume to process records for all users.
@@ -37,10 +57,29 @@ version: {}
     )
     arguments.add_argument(
         "-s", "--source",
-        dest="source",
+        dest="sources",
+        action="append",
+        required=False,
+        default=None,
+        help="The activities database or a logical volume (logical volume: \\\\.\\C:). Can be "
+             "used multiple times."
+    )
+    arguments.add_argument(
+        "--manifest",
+        dest="manifest",
+        action="store",
+        required=False,
+        default=None,
+        help="File listing sources to process, one per line. Blank lines and lines starting "
+             "with # are skipped."
+    )
+    arguments.add_argument(
+        "--source_dir",
+        dest="source_dir",
         action="store",
-        required=True,
-        help="The activities database or a logical volume (logical volume: \\\\.\\C:)."
+        required=False,
+        default=None,
+        help="Directory to search recursively for collected ActivitiesCache.db files to process."
     )
     arguments.add_argument(
         "-t", "--temp_dir",
@@ -50,6 +89,36 @@ version: {}
         default=None,
         help="The template directory for extractions if source is a logical volume."
     )
+    arguments.add_argument(
+        "--cleanup",
+        dest="cleanup",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Remove the temp directory of a logical volume after processing."
+    )
+    arguments.add_argument(
+        "--in_memory",
+        dest="in_memory",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Read the database and WAL of each user on a logical volume into memory and open "
+             "them with the WAL applied instead of extracting them to the temp directory "
+             "(Python 3.11+). The image of each database is kept twice while it is open, by "
+             "Python and by SQLite; with --sort the images of all users are open at once."
+    )
+    arguments.add_argument(
+        "--memory_limit",
+        dest="memory_limit",
+        action="store",
+        type=int,
+        required=False,
+        default=DEFAULT_MEMORY_LIMIT // (1024 * 1024),
+        help="The most MiB of database and WAL of a user to read with --in_memory, larger ones "
+             "are extracted to the temp directory. (default: {})".format(
+                 DEFAULT_MEMORY_LIMIT // (1024 * 1024))
+    )
     arguments.add_argument(
         "--sequence",
         dest="sequence",
@@ -59,6 +128,138 @@ version: {}
         default=0,
         help="Only display sequences above this value. (default: 0)"
     )
+    arguments.add_argument(
+        "--state",
+        dest="state",
+        action="store",
+        required=False,
+        default=None,
+        help="State file of the highest ETag collected per database. Only activities newer "
+             "than the state are output and the state is updated after the run."
+    )
+    arguments.add_argument(
+        "--start",
+        dest="start",
+        action="store",
+        required=False,
+        default=None,
+        help="Only output activities with a time field at or after this UTC time (YYYY-MM-DD[ HH:MM:SS])."
+    )
+    arguments.add_argument(
+        "--end",
+        dest="end",
+        action="store",
+        required=False,
+        default=None,
+        help="Only output activities with a time field at or before this UTC time (YYYY-MM-DD[ HH:MM:SS])."
+    )
+    arguments.add_argument(
+        "--time_field",
+        dest="time_field",
+        action="store",
+        required=False,
+        default="StartTime",
+        choices=ActivityFilter.TIME_FIELDS,
+        help="The time field --start and --end filter on. (default: StartTime)"
+    )
+    arguments.add_argument(
+        "--app",
+        dest="app",
+        action="store",
+        required=False,
+        default=None,
+        help="Only output activities with an AppId application containing this (case insensitive)."
+    )
+    arguments.add_argument(
+        "--activity_type",
+        dest="activity_types",
+        action="append",
+        type=int,
+        required=False,
+        default=None,
+        help="Only output activities of this ActivityType. Can be used multiple times."
+    )
+    arguments.add_argument(
+        "--user",
+        dest="users",
+        action="append",
+        required=False,
+        default=None,
+        help="Only process this user if source is a logical volume. Can be used multiple times."
+    )
+    arguments.add_argument(
+        "--enrich",
+        dest="enrich",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Add the Activity_PackageId platforms and package names of each activity as a "
+             "Packages field, joined by SQLite in the same query."
+    )
+    arguments.add_argument(
+        "--enrich_operations",
+        dest="enrich_operations",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Add the pending upload ActivityOperation rows of each activity as an Operations field."
+    )
+    arguments.add_argument(
+        "--discover",
+        dest="discover",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Find every ActivitiesCache.db on a logical volume by walking its directory metadata "
+             "once and open the files by inode, instead of following the CDPGlobalSettings.cdp "
+             "of each user in /Users."
+    )
+    arguments.add_argument(
+        "--wal_index",
+        dest="wal_index",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Apply the committed frames of ActivitiesCache.db-wal to an in memory copy of the "
+             "database instead of letting SQLite replay the WAL (Python 3.11+)."
+    )
+    arguments.add_argument(
+        "--wal_history",
+        dest="wal_history",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Output every activity version found in the database and each ActivitiesCache.db-wal "
+             "commit, including changed and deleted ones, tagged with _wal_commit (Python 3.11+). "
+             "Each commit that changes the Activity table is read as a full in memory copy of the "
+             "database, so the time grows with commits x database size."
+    )
+    arguments.add_argument(
+        "--sort",
+        dest="sort",
+        action="store",
+        required=False,
+        default=None,
+        choices=sorted(SORT_FIELDS.keys()),
+        help="Output the activities of all users and sources merged in order of this time "
+             "field. Each database is read in order by SQLite and merged, with --wal_history "
+             "the versions are sorted in runs spilled to --temp_dir. (default: each database "
+             "by descending ETag)"
+    )
+    arguments.add_argument(
+        "--summary",
+        dest="summary",
+        action="store",
+        required=False,
+        default=None,
+        choices=sorted(SUMMARIES.keys()),
+        help="Output aggregated rows instead of activities, grouped by SQLite in each database "
+             "with the filters applied and merged across users and sources: {}".format(
+                 " ".join(
+                     "{}: {}".format(name, SUMMARIES[name].description)
+                     for name in sorted(SUMMARIES.keys())
+                 ))
+    )
     arguments.add_argument(
         "-o", "--output_template",
         dest="output_template",
@@ -67,6 +268,92 @@ version: {}
         default=None,
         help="Output template format."
     )
+    arguments.add_argument(
+        "--fields",
+        dest="fields",
+        action="store",
+        required=False,
+        default=None,
+        help="Comma separated list of fields to output, only these columns are read from the "
+             "database. (default: the fields in the output template, otherwise all)"
+    )
+    arguments.add_argument(
+        "--output",
+        dest="output",
+        action="store",
+        required=False,
+        default=None,
+        help="Write the output to this file instead of stdout."
+    )
+    arguments.add_argument(
+        "--output_dir",
+        dest="output_dir",
+        action="store",
+        required=False,
+        default=None,
+        help="Write the jsonl or template output to this directory instead, one set of files "
+             "per source, user, cdp location and table, with a manifest.json of the rows and "
+             "bytes of each file."
+    )
+    arguments.add_argument(
+        "--compression",
+        dest="compression",
+        action="store",
+        required=False,
+        default="gzip",
+        choices=COMPRESSIONS,
+        help="Compression of the --output_dir files, compressed on background threads while "
+             "parsing goes on. zstd requires zstandard. (default: gzip)"
+    )
+    arguments.add_argument(
+        "--shard_size",
+        dest="shard_size",
+        action="store",
+        type=int,
+        required=False,
+        default=DEFAULT_SHARD_SIZE // (1024 * 1024),
+        help="MiB of uncompressed output per --output_dir file before the next one is "
+             "started. (default: {})".format(DEFAULT_SHARD_SIZE // (1024 * 1024))
+    )
+    arguments.add_argument(
+        "--compression_threads",
+        dest="compression_threads",
+        action="store",
+        type=int,
+        required=False,
+        default=DEFAULT_COMPRESSION_THREADS,
+        help="Number of threads compressing --output_dir files. (default: {})".format(
+            DEFAULT_COMPRESSION_THREADS)
+    )
+    arguments.add_argument(
+        "--format",
+        dest="format",
+        action="store",
+        required=False,
+        default="jsonl",
+        choices=["jsonl"] + COLUMNAR_FORMATS + ["sqlite"],
+        help="Output format, parquet and arrow require --output and pyarrow. With --dump_db each "
+             "table is written to <output>.<table>.<ext>. sqlite upserts activities into the "
+             "--output case database. (default: jsonl)"
+    )
+    arguments.add_argument(
+        "--batch_size",
+        dest="batch_size",
+        action="store",
+        type=int,
+        required=False,
+        default=DEFAULT_BATCH_SIZE,
+        help="Records per record batch for parquet and arrow output. (default: {})".format(DEFAULT_BATCH_SIZE)
+    )
+    arguments.add_argument(
+        "--buffer_size",
+        dest="buffer_size",
+        action="store",
+        type=int,
+        required=False,
+        default=DEFAULT_BUFFER_SIZE,
+        help="Bytes of output to buffer before writing. (default: {})".format(DEFAULT_BUFFER_SIZE)
+    )
     arguments.add_argument(
         "--dump_db",
         dest="dump_db",
@@ -75,6 +362,55 @@ version: {}
         default=False,
         help="Dump the entire ActivitiesCache.db database, not just the Activity table."
     )
+    arguments.add_argument(
+        "--dump_threads",
+        dest="dump_threads",
+        action="store",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of tables to read at the same time with --dump_db, each on its own "
+             "read-only connection. The records of the tables are interleaved. Decoding holds "
+             "the GIL, so this only helps when reading the database is the slow part, such as "
+             "a large database on slow storage. (default: 1)"
+    )
+    arguments.add_argument(
+        "--workers",
+        dest="workers",
+        action="store",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of worker processes to extract and parse users with if source is a "
+             "logical volume, or to process sources with if there are several. (default: 1)"
+    )
+    arguments.add_argument(
+        "--ordered",
+        dest="ordered",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Output worker results in user or source order instead of as they finish."
+    )
+    arguments.add_argument(
+        "--stats",
+        dest="stats",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Print the wall time, rows and bytes of each stage (extract, image, sqlite, decode, "
+             "format, write) per source to stderr. The image bytes are the memory held by "
+             "--in_memory databases."
+    )
+    arguments.add_argument(
+        "--profile",
+        dest="profile",
+        action="store",
+        required=False,
+        default=None,
+        help="Run under cProfile and dump the profile to this file (worker processes are not "
+             "profiled)."
+    )
     arguments.add_argument(
         "--debug",
         dest="debug",
@@ -87,67 +423,643 @@ version: {}
     return arguments
 
 
-def parse_file(options, formatter):
-    activities_db = ActivitiesDb(
-        options.source
+def get_sources(options):
+    """Get the sources from -s, --manifest and --source_dir, in that order without duplicates.
+    Files are returned as absolute paths, logical volumes as given."""
+    sources = list(options.sources or [])
+
+    if options.manifest:
+        with open(options.manifest, "r") as fh:
+            for line in fh:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    sources.append(line)
+
+    if options.source_dir:
+        for root, dirs, files in os.walk(options.source_dir):
+            dirs.sort()
+            for filename in sorted(files):
+                if filename.lower() == "activitiescache.db":
+                    sources.append(os.path.join(root, filename))
+
+    unique_sources = []
+    for source in sources:
+        if not is_logical_volume(source):
+            # the same key for a file however it was given, for --state and --format sqlite
+            source = os.path.abspath(source)
+        if source not in unique_sources:
+            unique_sources.append(source)
+    return unique_sources
+
+
+def get_fields(options, template):
+    """Get the output fields to read and decode, None = all fields."""
+    if options.fields:
+        fields = set(
+            field.strip() for field in options.fields.split(",")
+        )
+        if options.format == "sqlite":
+            fields.update(CaseStoreSink.REQUIRED_FIELDS)
+        return fields
+    elif template:
+        return template.field_names
+
+    return None
+
+
+def get_activity_filter(options):
+    """Get the ActivityFilter for the filter options, None if no filters are set."""
+    if not (options.start or options.end or options.app or options.activity_types):
+        return None
+
+    start = None
+    if options.start:
+        start = datetime_encode_1970(options.start)
+    end = None
+    if options.end:
+        end = datetime_encode_1970(options.end)
+
+    return ActivityFilter(
+        start=start, end=end, time_field=options.time_field,
+        app=options.app, activity_types=options.activity_types
     )
-    if options.dump_db:
-        for record in activities_db.iter_records():
-            formatted_record = record.as_ordered_dict()
-            formatted_record["_table"] = record._table
-            if formatter:
-                output = formatter.format(
-                    options.output_template, **formatted_record
-                )
-                print(output)
-            else:
-                print(ujson.dumps(
-                    formatted_record
-                ))
+
+
+def output_record(record, template, output_sink, extra, record_timer=None):
+    if hasattr(output_sink, "write_record"):
+        if record_timer is not None:
+            record_timer.write_record(output_sink, record, extra)
+        else:
+            output_sink.write_record(record, extra)
+        return
+
+    if record_timer is not None:
+        output_sink.write(record_timer.format_record(record, extra, template))
     else:
-        sequence = activities_db.get_activity_sequence()
-        logging.info("Activity Sequence: {}".format(sequence))
-
-        for record in activities_db.iter_activities(options.sequence):
-            formatted_record = record.as_ordered_dict()
-            if formatter:
-                output = formatter.format(
-                    options.output_template, **formatted_record
+        output_sink.write(format_record(record, extra, template))
+
+
+def get_wal_location(options):
+    wal_location = options.source + "-wal"
+    if os.path.isfile(wal_location):
+        return wal_location
+
+    logging.info("No WAL file found: {}".format(wal_location))
+    return None
+
+
+def get_sort_field(options):
+    """Get the Activity column of --sort, None = descending ETag per database."""
+    if options.sort is None:
+        return None
+    return SORT_FIELDS[options.sort]
+
+
+def parse_file(options, template, output_sink, state, extra=None, stats=None):
+    if stats is None:
+        _parse_file(options, template, output_sink, state, extra or {})
+        return
+
+    sink_position = stats.get_sink_position(output_sink)
+    _parse_file(options, template, output_sink, state, extra or {}, stats)
+    stats.add_sink(options.source, "write", output_sink, sink_position)
+
+
+def _parse_file(options, template, output_sink, state, extra, stats=None):
+    record_timer = None
+    if stats is not None:
+        record_timer = RecordTimer(stats, options.source)
+
+    if options.sort and options.wal_history:
+        keyed_records = iter_sorted_file_records(options, template, state, extra, stats)
+        records = ((record, record_extra) for _, record, record_extra in keyed_records)
+    else:
+        # activities are read in --sort order by SQLite
+        records = iter_file_records(options, template, state, extra, stats)
+
+    for record, record_extra in records:
+        output_record(
+            record, template, output_sink, record_extra, record_timer
+        )
+
+
+def iter_file_records(options, template, state, extra, stats=None):
+    """Iterate the records of a database file and the extra fields to output with them.
+
+    Yields:
+        (tuple): (record, extra fields)
+    """
+    def timed(records):
+        if stats is None:
+            return records
+        return stats.iter_timed(records, options.source, "sqlite")
+
+    if options.wal_history:
+        versions = iter_activity_versions(
+            options.source, get_wal_location(options),
+            get_fields(options, template), get_activity_filter(options),
+            options.enrich, options.enrich_operations, get_sort_field(options)
+        )
+        for commit, record in timed(versions):
+            yield record, dict({"_wal_commit": commit}, **extra)
+        return
+
+    db_options = {}
+    if options.wal_index:
+        db_options["wal"] = get_wal_location(options)
+
+    with ActivitiesDb(options.source, **db_options) as activities_db:
+        fields = get_fields(options, template)
+
+        if options.dump_db:
+            for record in timed(activities_db.iter_records(fields, options.dump_threads)):
+                yield record, dict({"_table": record._table}, **extra)
+        else:
+            sequence = activities_db.get_activity_sequence()
+            logging.info("Activity Sequence: {}".format(sequence))
+
+            start_sequence = options.sequence
+            if state is not None:
+                state_key = state.get_key(os.path.abspath(options.source))
+                max_etag = activities_db.get_max_etag()
+                start_sequence = max(
+                    start_sequence, state.get_sequence(state_key, sequence)
                 )
-                print(output)
-            else:
-                print(ujson.dumps(
-                    formatted_record
-                ))
+                logging.info("Continuing from ETag: {}".format(start_sequence))
+
+            records = activities_db.iter_activities(
+                start_sequence, fields, get_activity_filter(options),
+                options.enrich, options.enrich_operations, get_sort_field(options)
+            )
+            for record in timed(records):
+                yield record, extra
+
+            if state is not None:
+                state.update(state_key, max_etag, sequence)
+
+
+def iter_sorted_file_records(options, template, state, extra, stats=None):
+    """Iterate the activities of a database file in --sort order.
+
+    Yields:
+        (tuple): (sort key, record, extra fields)
+    """
+    keyed_records = iter_keyed_records(
+        iter_file_records(options, template, state, extra, stats)
+    )
+    if options.wal_history:
+        # the versions of each commit are in order, all versions together are not
+        keyed_records = iter_external_sorted(keyed_records, options.temp_dir)
+    return keyed_records
 
 
-def parse_logical(options):
+def get_volume_processor(options, state, extra=None, stats=None):
     tsk_img = pytsk3.Img_Info(
         options.source
     )
-    processor = VolumeProcessor(
+    return VolumeProcessor(
         tsk_img, description=options.source,
         temp_location=options.temp_dir,
+        cleanup=options.cleanup,
         output_template=options.output_template,
-        dump_db=options.dump_db
+        dump_db=options.dump_db,
+        dump_threads=options.dump_threads,
+        fields=get_fields(options, None),
+        activity_filter=get_activity_filter(options),
+        enrich=options.enrich,
+        enrich_operations=options.enrich_operations,
+        users=options.users,
+        state=state,
+        wal_index=options.wal_index,
+        wal_history=options.wal_history,
+        extra=extra,
+        stats=stats,
+        discover=options.discover,
+        source=options.source,
+        workers=options.workers,
+        ordered=options.ordered,
+        sort_field=get_sort_field(options),
+        in_memory=options.in_memory,
+        memory_limit=options.memory_limit * 1024 * 1024
     )
-    processor.process()
+
+
+def parse_logical(options, output_sink, state, extra=None, stats=None):
+    processor = get_volume_processor(options, state, extra, stats)
+    processor.process(output_sink)
+
+
+def parse_source(options, template, output_sink, state, extra=None, stats=None):
+    if is_logical_volume(options.source):
+        parse_logical(options, output_sink, state, extra, stats)
+    else:
+        parse_file(options, template, output_sink, state, extra, stats)
+
+
+def parse_batch_source(options, source, template, output_sink, state, stats=None):
+    """Process one source of a batch. Errors are logged and reported in the
+    summary so that the other sources are still processed.
+
+    Returns:
+        (dict): The summary of the source.
+    """
+    source_options = copy.copy(options)
+    source_options.source = source
+    records_written = output_sink.records_written
+    start_time = time.time()
+
+    summary = {
+        "source": source,
+        "status": "ok",
+        "error": None
+    }
+    try:
+        parse_source(
+            source_options, template, output_sink, state, {"_source": source}, stats
+        )
+    except BrokenPipeError:
+        raise
+    except Exception as error:
+        logging.error("Error processing {}: {}".format(
+            source, traceback.format_exc()
+        ))
+        summary["status"] = "error"
+        summary["error"] = str(error)
+
+    if hasattr(output_sink, "finish_source"):
+        # close the files of the source rather than keeping them open for the whole batch
+        output_sink.finish_source(source)
+
+    summary["records"] = output_sink.records_written - records_written
+    summary["seconds"] = time.time() - start_time
+    return summary
+
+
+def iter_file_summary(options, activity_summary, extra, stats=None):
+    """Iterate the rows of a Summary of a database file, aggregated by SQLite.
+
+    Yields:
+        (tuple): (merge key, row)
+    """
+    db_options = {}
+    if options.wal_index:
+        db_options["wal"] = get_wal_location(options)
+
+    with ActivitiesDb(options.source, **db_options) as activities_db:
+        rows = activities_db.iter_summary(activity_summary, get_activity_filter(options))
+        if stats is not None:
+            rows = stats.iter_timed(rows, options.source, "sqlite")
+        for keyed_row in iter_keyed_rows(activity_summary, rows, extra):
+            yield keyed_row
+
+
+def _iter_merged_source(options, source, template, state, summary, stats=None,
+                        activity_summary=None):
+    """Iterate the keyed items of one source to merge with the other sources, the
+    activities in --sort order or the rows of a --summary. Errors are logged and
+    reported in the summary, which ends the source but not the others.
+
+    Yields:
+        (tuple): (sort key, record, extra fields) or (merge key, summary row)
+    """
+    source_options = copy.copy(options)
+    source_options.source = source
+    extra = {"_source": source}
+    start_time = time.time()
+    try:
+        if activity_summary is not None and is_logical_volume(source):
+            processor = get_volume_processor(source_options, None, extra, stats)
+            keyed_items = processor.iter_summary(activity_summary)
+        elif activity_summary is not None:
+            keyed_items = iter_file_summary(source_options, activity_summary, extra, stats)
+        elif is_logical_volume(source):
+            processor = get_volume_processor(source_options, state, extra, stats)
+            keyed_items = processor.iter_sorted_records()
+        else:
+            keyed_items = iter_sorted_file_records(
+                source_options, template, state, extra, stats
+            )
+
+        for keyed_item in keyed_items:
+            summary["records"] += 1
+            yield keyed_item
+    except BrokenPipeError:
+        raise
+    except Exception as error:
+        logging.error("Error processing {}: {}".format(
+            source, traceback.format_exc()
+        ))
+        summary["status"] = "error"
+        summary["error"] = str(error)
+    finally:
+        summary["seconds"] += time.time() - start_time
+
+
+def _get_merged_streams(options, sources, template, state, stats=None, activity_summary=None):
+    """Get the keyed stream and the summary of each source of a merged batch.
+
+    Returns:
+        (list, list): The streams and the summaries.
+    """
+    if options.workers > 1:
+        logging.warning("--workers is not used with --sort or --summary, sources are merged "
+                        "in one process.")
+
+    summaries = []
+    streams = []
+    for source in sources:
+        summary = {
+            "source": source,
+            "status": "ok",
+            "error": None,
+            "records": 0,
+            "seconds": 0.0
+        }
+        summaries.append(summary)
+        streams.append(_iter_merged_source(
+            options, source, template, state, summary, stats, activity_summary
+        ))
+    return streams, summaries
+
+
+def parse_sorted_batch(options, sources, template, output_sink, state, stats=None):
+    """Merge the activities of all sources in --sort order. Every source is read in
+    order, so only the next record of each source is held while merging.
+
+    Returns:
+        (list): The summary of each source.
+    """
+    streams, summaries = _get_merged_streams(options, sources, template, state, stats)
+
+    record_timers = {}
+    for _, record, extra in merge_sorted(streams):
+        record_timer = None
+        if stats is not None:
+            source = extra["_source"]
+            record_timer = record_timers.get(source)
+            if record_timer is None:
+                record_timer = record_timers[source] = RecordTimer(stats, source)
+        output_record(record, template, output_sink, extra, record_timer)
+
+    return summaries
+
+
+def parse_summary(options, sources, batch, template, output_sink, stats=None):
+    """Write the rows of a --summary, aggregated by SQLite in each database and merged
+    across the users and sources. The rows of a batch are kept apart by _source where
+    the summary is per user.
+
+    Returns:
+        (list): The summary of each source, None if it is not a batch.
+    """
+    activity_summary = SUMMARIES[options.summary]
+    if batch:
+        streams, summaries = _get_merged_streams(
+            options, sources, template, None, stats, activity_summary
+        )
+    elif is_logical_volume(options.source):
+        streams = [get_volume_processor(options, None, None, stats).iter_summary(activity_summary)]
+        summaries = None
+    else:
+        streams = [iter_file_summary(options, activity_summary, None, stats)]
+        summaries = None
+
+    for _, row in iter_merged_rows(activity_summary, streams):
+        output_sink.write(format_row(activity_summary.format_row(row), template))
+
+    return summaries
+
+
+def _parse_batch_job(job):
+    """Worker for a batch source. The output is written to a temp file that the
+    parent copies into its sink.
+
+    Params:
+        job (tuple): (options, source, state)
+    Returns:
+        (tuple): (summary, output location, state entries updated by the source, Stats or None)
+    """
+    options, source, state = job
+    set_debug_level(options.debug)
+
+    template = None
+    if options.output_template:
+        template = compile_template(options.output_template)
+
+    # the batch is already spread over the workers
+    options = copy.copy(options)
+    options.workers = 1
+
+    output_handle, output_location = tempfile.mkstemp(
+        suffix=".txt", dir=options.temp_dir
+    )
+    os.close(output_handle)
+
+    stats = None
+    if options.stats:
+        stats = Stats()
+
+    with OutputSink(output_location, buffer_size=options.buffer_size) as output_sink:
+        summary = parse_batch_source(
+            options, source, template, output_sink, state, stats
+        )
+        if stats is not None:
+            sink_position = stats.get_sink_position(output_sink)
+    if stats is not None:
+        # the last buffer is written on close
+        stats.add_sink(source, "write", output_sink, sink_position)
+
+    state_entries = None
+    if state is not None:
+        # only the entries of this source, the others are as they were when the job was sent
+        state_entries = state.get_updated_entries()
+    return summary, output_location, state_entries, stats
+
+
+def parse_batch(options, sources, template, output_sink, state, stats=None):
+    """Process several sources with a bounded pool of worker processes.
+
+    Returns:
+        (list): The summary of each source.
+    """
+    if options.sort:
+        return parse_sorted_batch(options, sources, template, output_sink, state, stats)
+
+    summaries = []
+    if options.workers <= 1 or len(sources) == 1 or hasattr(output_sink, "write_record"):
+        if options.workers > 1 and hasattr(output_sink, "write_record"):
+            output_option = "--output_dir"
+            if not options.output_dir:
+                output_option = "--format {}".format(options.format)
+            logging.warning("--workers is not used with {}, sources are processed "
+                            "sequentially.".format(output_option))
+
+        for source in sources:
+            summaries.append(parse_batch_source(
+                options, source, template, output_sink, state, stats
+            ))
+        return summaries
+
+    jobs = [(options, source, state) for source in sources]
+    with multiprocessing.Pool(min(options.workers, len(jobs))) as pool:
+        if options.ordered:
+            results = pool.imap(_parse_batch_job, jobs)
+        else:
+            results = pool.imap_unordered(_parse_batch_job, jobs)
+
+        for summary, output_location, state_entries, source_stats in results:
+            if stats is not None:
+                sink_position = stats.get_sink_position(output_sink)
+            try:
+                output_sink.copy_file(output_location)
+            finally:
+                os.remove(output_location)
+            if stats is not None and source_stats is not None:
+                stats.merge(source_stats)
+                stats.add_sink(summary["source"], "copy", output_sink, sink_position)
+
+            output_sink.records_written += summary["records"]
+            if state_entries:
+                for state_key, state_entry in state_entries.items():
+                    state.entries[state_key] = state_entry
+            summaries.append(summary)
+
+    return summaries
+
+
+def print_batch_summary(summaries):
+    failed = [summary for summary in summaries if summary["status"] != "ok"]
+    sys.stderr.write("Processed {} sources: {} ok, {} failed, {} records\n".format(
+        len(summaries), len(summaries) - len(failed), len(failed),
+        sum(summary["records"] for summary in summaries)
+    ))
+    for summary in summaries:
+        line = "  {:<5} {:>10} {:>8.1f}s  {}".format(
+            summary["status"], summary["records"], summary["seconds"], summary["source"]
+        )
+        if summary["error"]:
+            line += " ({})".format(summary["error"])
+        sys.stderr.write(line + "\n")
 
 
 def main():
     arguments = get_arguments()
     options = arguments.parse_args()
 
-    formatter = None
+    sources = get_sources(options)
+    if not sources:
+        arguments.error("a source is required, use -s, --manifest or --source_dir")
+    batch = len(sources) > 1 or bool(options.manifest or options.source_dir)
+    options.source = sources[0]
+
+    if options.format != "jsonl":
+        if not options.output:
+            arguments.error("--output is required for --format {}".format(options.format))
+        if options.output_template:
+            arguments.error("-o cannot be used with --format {}".format(options.format))
+    if options.format == "sqlite" and options.dump_db:
+        arguments.error("--dump_db cannot be used with --format sqlite")
+    if (options.enrich or options.enrich_operations) and options.dump_db:
+        arguments.error("--enrich cannot be used with --dump_db")
+    if options.sort and options.dump_db:
+        arguments.error("--sort cannot be used with --dump_db")
+    if options.output_dir and (options.output or options.format != "jsonl" or options.summary):
+        arguments.error("--output_dir cannot be used with --output, --format or --summary")
+    if options.summary and (options.format != "jsonl" or options.dump_db or options.sort
+                            or options.wal_history or options.state):
+        arguments.error("--summary cannot be used with --format {}, --dump_db, --sort, "
+                        "--wal_history or --state".format(options.format))
+    if options.wal_history and (options.dump_db or options.state):
+        arguments.error("--wal_history cannot be used with --dump_db or --state")
+
+    template = None
     if options.output_template:
-        formatter = CustomStringFormatter()
+        template = compile_template(options.output_template)
 
     set_debug_level(options.debug)
 
-    if re.match('\\\\\\\.\\\[a-zA-Z]:', options.source):
-        parse_logical(options)
+    state = None
+    if options.state:
+        state = StateFile(options.state)
+
+    if options.output_dir:
+        output_sink = ShardedSink(
+            options.output_dir, template, compression=options.compression,
+            shard_size=options.shard_size * 1024 * 1024, threads=options.compression_threads
+        )
+    elif options.format == "jsonl":
+        output_sink = OutputSink(
+            options.output, buffer_size=options.buffer_size
+        )
+    elif options.format == "sqlite":
+        source = None
+        if not batch:
+            source = options.source
+        output_sink = CaseStoreSink(
+            options.output, source
+        )
     else:
-        parse_file(options, formatter)
+        output_sink = ColumnarSink(
+            options.output, file_format=options.format,
+            batch_size=options.batch_size, split_tables=options.dump_db
+        )
+
+    stats = None
+    if options.stats:
+        stats = Stats()
+
+    profile = None
+    if options.profile:
+        profile = cProfile.Profile()
+        profile.enable()
+
+    # the output of a merged batch is written for all sources at once
+    merged_batch = batch and bool(options.sort or options.summary)
+    summaries = None
+    with output_sink:
+        if stats is not None:
+            merged_position = stats.get_sink_position(output_sink)
+
+        if options.summary:
+            summaries = parse_summary(
+                options, sources, batch, template, output_sink, stats
+            )
+        elif batch:
+            summaries = parse_batch(
+                options, sources, template, output_sink, state, stats
+            )
+        else:
+            parse_source(options, template, output_sink, state, stats=stats)
+
+        if stats is not None:
+            sink_position = stats.get_sink_position(output_sink)
+
+    if stats is not None and merged_batch:
+        stats.add_sink(BATCH_STATS_SOURCE, "write", output_sink, merged_position)
+    elif stats is not None:
+        # the last buffer is written on close
+        last_source = options.source
+        if summaries:
+            last_source = summaries[-1]["source"]
+        stats.add_sink(last_source, "write", output_sink, sink_position)
+
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(options.profile)
+        logging.info("Wrote profile to {}".format(options.profile))
+
+    if summaries is not None and not output_sink.broken_pipe:
+        print_batch_summary(summaries)
+    if stats is not None and not output_sink.broken_pipe:
+        stats.write_report()
+
+    # only move the state forward when all of the output was written
+    if state is not None and not output_sink.broken_pipe:
+        state.save()
+
+    # the sources that did not fail are written and saved, but the run did not succeed
+    if summaries and any(summary["status"] != "ok" for summary in summaries):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
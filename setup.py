@@ -10,7 +10,7 @@ setup(
     packages=[
         'winactivities'
     ],
-    python_requires='>=3',
+    python_requires='>=3.6',
     install_requires=[
         'ujson',
         'pytsk3'
@@ -1,7 +1,11 @@
+import queue
 import ujson
+import logging
 import binascii
-from collections import OrderedDict
+import threading
 from winactivities.helpers import DbHandler, datetime_decode_1970_str
+from winactivities.wal import WalIndex, get_page_size, get_btree_pages
+from winactivities.batches import DEFAULT_BATCH_SIZE, get_batch_plan, iter_column_batches, build_dataframe
 
 ACTIVITIES_SCHEMA = {
     "tables": [
@@ -17,35 +21,401 @@ ACTIVITIES_SCHEMA = {
         "SmartLookup"
     ]
 }
+# rows fetched per batch when dumping tables
+DUMP_BATCH_SIZE = 1000
+
+# the package names of each activity, grouped into a JSON array
+PACKAGES_JOIN = """
+    LEFT JOIN (
+        SELECT ActivityId AS PackageActivityId, json_group_array(json_object(
+            'Platform', Platform, 'PackageName', PackageName
+        )) AS Packages
+        FROM (SELECT * FROM Activity_PackageId ORDER BY rowid)
+        GROUP BY ActivityId
+    ) ON PackageActivityId = Activity.Id
+"""
+# the pending upload operations of each activity, grouped into a JSON array
+OPERATIONS_JOIN = """
+    LEFT JOIN (
+        SELECT Id AS OperationActivityId, json_group_array(json_object(
+            'OperationOrder', OperationOrder, 'OperationType', OperationType,
+            'CreatedTime', datetime(CreatedTime, 'unixepoch'),
+            'LastModifiedTime', datetime(LastModifiedTime, 'unixepoch'), 'ETag', ETag
+        )) AS Operations
+        FROM (SELECT * FROM ActivityOperation ORDER BY OperationOrder)
+        GROUP BY Id
+    ) ON OperationActivityId = Activity.Id
+"""
+
+
+def iter_wal_versions(source, wal_location, db_data=None, wal_data=None, table_names=None,
+                      **kwargs):
+    """Iterate the database at every commit of its WAL, starting with the database file
+    alone. The WAL is indexed once and each version is patched from the previous one.
+
+    Every version is a full copy of the database opened in memory, so reading all of
+    them costs about commits x database size. With table_names, the commits that do not
+    write a page of those tables, such as updates to other tables, are skipped.
+
+    Params:
+        source (unicode): The ActivitiesCache.db location.
+        wal_location (unicode): The ActivitiesCache.db-wal location.
+        db_data (bytes): The database contents, read instead of source if set.
+        wal_data (bytes): The WAL contents, read instead of wal_location if db_data is set.
+        table_names (list): Only yield the versions where these tables changed. None = all.
+        kwargs: DbHandler options.
+    Yields:
+        (tuple): (number of commits applied, ActivitiesDb)
+    """
+    if db_data is not None:
+        wal_index = WalIndex(wal_data or b"")
+    elif wal_location is None:
+        with ActivitiesDb(source, **kwargs) as activities_db:
+            yield 0, activities_db
+        return
+    else:
+        wal_index = WalIndex.from_file(wal_location)
+        with open(source, "rb") as fh:
+            db_data = fh.read()
+
+    tracked_pages = None
+    schema_data = None
+    skipped = 0
+    for commit, image in wal_index.iter_images(db_data):
+        if tracked_pages is not None:
+            changed_pages = wal_index.get_commit_pages(commit) & tracked_pages
+            page_size = get_page_size(image)
+            if changed_pages == {1} and image[100:page_size] == schema_data:
+                # only the database header changed, such as the size of the file
+                changed_pages = None
+            if not changed_pages:
+                skipped += 1
+                continue
+
+        with ActivitiesDb(source, image=image, **kwargs) as activities_db:
+            if table_names is not None:
+                # the schema and table pages of this version, a commit that writes none
+                # of them leaves the rows of the tables as they are
+                page_size = get_page_size(image)
+                tracked_pages = get_btree_pages(image, page_size, 1)
+                for root_page in activities_db.get_root_pages(table_names):
+                    tracked_pages |= get_btree_pages(image, page_size, root_page)
+                schema_data = bytes(image[100:page_size])
+            yield commit, activities_db
+
+    if skipped:
+        logging.info("Skipped {} of {} WAL commits that did not change {}".format(
+            skipped, len(wal_index.commits), ", ".join(table_names)
+        ))
+
+
+def iter_activity_versions(source, wal_location, fields=None, activity_filter=None, enrich=False,
+                           enrich_operations=False, sort_field=None, db_data=None, wal_data=None):
+    """Iterate every version of the activities found in the database and its WAL commits,
+    including versions that a later commit changed or deleted. The query is run again on
+    each commit that changes the tables it reads, see iter_wal_versions for the cost.
+
+    Params:
+        source (unicode): The ActivitiesCache.db location.
+        wal_location (unicode): The ActivitiesCache.db-wal location, None = no WAL.
+        fields (set): Only decode these output fields (Id and ETag are always read).
+            None = all fields.
+        activity_filter (ActivityFilter): Only return records matching the filter.
+        enrich (bool): True = Add the Packages of each activity.
+        enrich_operations (bool): True = Also add the pending upload Operations of each activity.
+        sort_field (unicode): Order the records of each commit by this Activity column.
+            The versions of all commits together are not in order.
+        db_data (bytes): The database contents, read instead of source if set.
+        wal_data (bytes): The WAL contents, read instead of wal_location if db_data is set.
+    Yields:
+        (tuple): (number of commits applied when the version was first seen, ActivityRecord)
+    """
+    if fields is not None:
+        fields = set(fields) | {"Id", "ETag"}
+
+    # the tables the query reads, commits that change none of them add no versions
+    table_names = ["Activity"]
+    if enrich:
+        table_names.append("Activity_PackageId")
+    if enrich_operations:
+        table_names.append("ActivityOperation")
+
+    seen = set()
+    versions = iter_wal_versions(source, wal_location, db_data, wal_data, table_names)
+    for commit, activities_db in versions:
+        records = activities_db.iter_activities(
+            0, fields, activity_filter, enrich, enrich_operations, sort_field
+        )
+        for record in records:
+            version = (record["Id"], record["ETag"])
+            if version in seen:
+                continue
+
+            seen.add(version)
+            yield commit, record
 
 
 class ActivitiesDb(object):
-    def __init__(self, source):
+    def __init__(self, source, wal=None, wal_commit=None, **kwargs):
+        """Create ActivitiesDb
+
+        Params:
+            source (unicode): The ActivitiesCache.db location.
+            wal (unicode): The ActivitiesCache.db-wal location. If set, the committed WAL
+                frames are applied to an in memory image of the database through a
+                WalIndex, instead of SQLite replaying the WAL.
+            wal_commit (int): The number of WAL commits to apply, None = all commits.
+            kwargs: DbHandler options (read_only, mmap_size, cache_size, temp_store).
+        """
         self._source = source
+        if wal is not None:
+            wal_index = WalIndex.from_file(wal)
+            with open(source, "rb") as fh:
+                kwargs["image"] = wal_index.get_image(fh.read(), wal_commit)
+
+        self._db_options = kwargs
         self.db_handler = DbHandler(
-            database=self._source
+            database=self._source, **kwargs
         )
 
-    def iter_records(self):
-        for table_name in ACTIVITIES_SCHEMA["tables"]:
-            query_str = """
-                SELECT rowid, *
-                FROM {}
-            """.format(table_name)
-            for row in self.db_handler.iter_rows(query_str):
-                record = self.get_record(table_name, row)
-                setattr(record, "_table", table_name)
-                yield record
-
-    def get_record(self, collection_name, row):
+    def close(self):
+        self.db_handler.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def iter_records(self, fields=None, threads=1):
+        """Iterate the records of every table and of the ACTIVITIES_SCHEMA views. Records
+        are tagged with their table name.
+
+        Params:
+            fields (set): Only decode these output fields. None = all fields.
+            threads (int): The number of tables to read at the same time, each on its own
+                read-only connection. With more than one, the records of the tables are
+                interleaved.
+        """
+        dump_tables = self.get_dump_tables()
+        if threads <= 1:
+            for table_name, is_view in dump_tables:
+                for record in self.iter_table_records(table_name, fields, is_view):
+                    yield record
+            return
+
+        for record in self._iter_records_threaded(dump_tables, fields, threads):
+            yield record
+
+    def get_dump_tables(self):
+        """Get the tables and views to dump. The tables come from sqlite_master, so the
+        tables of schema versions that ACTIVITIES_SCHEMA does not know are dumped too.
+
+        Returns:
+            (list): (name, is view) tuples, the ACTIVITIES_SCHEMA tables first.
+        """
+        cursor = self.db_handler.execute(
+            "SELECT type, name FROM sqlite_master "
+            "WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite!_%' ESCAPE '!'"
+        )
+        tables = []
+        views = set()
+        for object_type, name in cursor:
+            if object_type == "view":
+                views.add(name)
+            else:
+                tables.append(name)
+
+        known_tables = ACTIVITIES_SCHEMA["tables"]
+        tables.sort(key=lambda name: (
+            known_tables.index(name) if name in known_tables else len(known_tables), name
+        ))
+
+        return [(name, False) for name in tables] + [
+            (name, True) for name in ACTIVITIES_SCHEMA["views"] if name in views
+        ]
+
+    def iter_table_records(self, table_name, fields=None, is_view=False,
+                           batch_size=DUMP_BATCH_SIZE):
+        """Iterate the records of a table or view, fetching the rows in batches.
+
+        Params:
+            table_name (unicode): The table or view.
+            fields (set): Only decode these output fields. None = all fields.
+            is_view (bool): True = The table is a view, it has no rowid.
+            batch_size (int): The number of rows to fetch at a time.
+        """
+        batches = self._iter_table_batches(table_name, fields, is_view, batch_size)
+        for record_class, layout, rows in batches:
+            for row in rows:
+                yield record_class(row, layout, table_name)
+
+    def _iter_table_batches(self, table_name, fields, is_view, batch_size=DUMP_BATCH_SIZE):
+        """Iterate the rows of a table in fetchmany batches.
+
+        Yields:
+            (tuple): (record class, RecordLayout, list of rows)
+        """
+        record_class = self.get_record_class(table_name)
+        query_str = """
+            SELECT {}
+            FROM "{}"
+        """.format(
+            self.get_select_columns(table_name, record_class, fields, is_view),
+            table_name
+        )
+        cursor = self.db_handler.execute(query_str)
+        layout = record_class.get_layout(
+            cursor.description, fields, self.get_column_types(table_name)
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield record_class, layout, rows
+
+    def _iter_records_threaded(self, dump_tables, fields, threads):
+        """Read the tables on reader threads, each with its own connection. SQLite
+        releases the GIL while it reads, so the readers fetch the next rows while the
+        records are decoded. The row batches are passed through a bounded queue, so
+        the readers wait when the records are not consumed fast enough."""
+        tables = queue.Queue()
+        for dump_table in dump_tables:
+            tables.put(dump_table)
+        batches = queue.Queue(maxsize=threads * 2)
+        stopped = threading.Event()
+
+        def read_tables():
+            try:
+                with ActivitiesDb(self._source, **self._db_options) as activities_db:
+                    while not stopped.is_set():
+                        try:
+                            table_name, is_view = tables.get_nowait()
+                        except queue.Empty:
+                            return
+
+                        table_batches = activities_db._iter_table_batches(
+                            table_name, fields, is_view
+                        )
+                        for batch in table_batches:
+                            if not _put_unless_stopped(batches, (table_name, batch), stopped):
+                                return
+            except Exception as error:
+                _put_unless_stopped(batches, error, stopped)
+            finally:
+                _put_unless_stopped(batches, None, stopped)
+
+        readers = [
+            threading.Thread(target=read_tables, name="dump-{}".format(index))
+            for index in range(min(threads, len(dump_tables)))
+        ]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+
+        try:
+            running = len(readers)
+            while running:
+                item = batches.get()
+                if item is None:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    # the records are created here, the readers only fetch rows
+                    table_name, (record_class, layout, rows) = item
+                    for row in rows:
+                        yield record_class(row, layout, table_name)
+        finally:
+            stopped.set()
+            for reader in readers:
+                while reader.is_alive():
+                    try:
+                        batches.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+
+    def get_record_class(self, collection_name):
         if collection_name == "Activity":
-            return ActivityRecord(row)
+            return ActivityRecord
         elif collection_name == "Activity_PackageId":
-            return PackageIdRecord(row)
+            return PackageIdRecord
         elif collection_name == "ActivityOperation":
-            return ActivityOperationRecord(row)
+            return ActivityOperationRecord
+        else:
+            return GenericRecord
+
+    def get_table_columns(self, table_name):
+        """Get the column names of a table."""
+        return list(self.get_column_types(table_name).keys())
+
+    def get_column_types(self, table_name):
+        """Get the declared types of the columns of a table.
+
+        Returns:
+            (dict): column name -> declared type (upper case)
+        """
+        cursor = self.db_handler.execute(
+            'PRAGMA table_info("{}")'.format(table_name)
+        )
+        return {
+            row[1]: row[2].upper() for row in cursor
+        }
+
+    def get_select_columns(self, table_name, record_class, fields=None, is_view=False,
+                           table_alias=None):
+        """Get the SELECT column list needed to output the fields of a record.
+
+        Params:
+            table_name (unicode): The table to select from.
+            record_class (GenericRecord): The record type of the table.
+            fields (set): The output fields. None = all fields.
+            is_view (bool): True = The table is a view, it has no rowid.
+            table_alias (unicode): Qualify the columns with this name, for joined queries.
+        Returns:
+            (unicode): The column list for the query.
+        """
+        prefix = '"{}".'.format(table_alias) if table_alias else ""
+        if fields is None:
+            if is_view:
+                return prefix + "*"
+            return "{0}rowid, {0}*".format(prefix)
+
+        table_columns = self.get_table_columns(table_name)
+        if not is_view:
+            table_columns = ["rowid"] + table_columns
+        if record_class.FIELDS is None:
+            columns = [column for column in table_columns if column in fields]
         else:
-            return GenericRecord(row)
+            columns = [
+                column for key, column, decoder in record_class.FIELDS
+                if key in fields and column in table_columns
+            ]
+
+        if not columns:
+            # nothing from the table is output, still return a row per record
+            if is_view:
+                return "NULL"
+            columns = ["rowid"]
+
+        return ", ".join(
+            '{}"{}"'.format(prefix, column) for column in columns
+        )
+
+    def get_root_pages(self, table_names):
+        """Get the root page numbers of the tables that exist."""
+        cursor = self.db_handler.execute(
+            "SELECT rootpage FROM sqlite_master WHERE type = 'table' AND name IN ({})".format(
+                ", ".join("?" * len(table_names))
+            ), table_names
+        )
+        return [root_page for root_page, in cursor]
+
+    def has_table(self, table_name):
+        cursor = self.db_handler.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)
+        )
+        return cursor.fetchone() is not None
 
     def get_activity_sequence(self):
         sequence_query_str = """
@@ -55,138 +425,448 @@ class ActivitiesDb(object):
         ManualSequence
         WHERE "Key" LIKE "Activity"
         """
-        connection = self.db_handler.get_connection()
-        cursor = connection.cursor()
-        cursor.execute(sequence_query_str)
+        cursor = self.db_handler.execute(sequence_query_str)
         sequence = cursor.fetchone()
         return sequence[0]
 
-    def iter_activities(self, sequence=0):
+    def get_max_etag(self):
+        """Get the highest Activity ETag, None if there are no activities."""
+        cursor = self.db_handler.execute(
+            "SELECT MAX(ETag) FROM Activity"
+        )
+        return cursor.fetchone()[0]
+
+    def iter_activities(self, sequence=0, fields=None, activity_filter=None, enrich=False,
+                        enrich_operations=False, sort_field=None):
+        """Iterate the Activity records above a sequence.
+
+        Params:
+            sequence (int): Only return records with an ETag above this value.
+            fields (set): Only decode these output fields. None = all fields.
+            activity_filter (ActivityFilter): Only return records matching the filter.
+            enrich (bool): True = Join the Activity_PackageId rows of each activity into a
+                Packages field, in the same query.
+            enrich_operations (bool): True = Also join the pending upload ActivityOperation
+                rows of each activity into an Operations field.
+            sort_field (unicode): Order the records by this Activity column, then by ETag,
+                instead of by descending ETag. The column value is also selected as
+                _sort_key, which is not an output field.
+        """
+        cursor, record_class, layout = self._execute_activities(
+            sequence, fields, activity_filter, enrich, enrich_operations, sort_field
+        )
+        for row in cursor:
+            yield record_class(row, layout)
+
+    def iter_batches(self, batch_size=DEFAULT_BATCH_SIZE, columns=None, activity_filter=None,
+                     sequence=0, numpy=False):
+        """Iterate the Activity records above a sequence as column batches, without
+        creating a record per row. Rows are in the order of iter_activities.
+
+        Params:
+            batch_size (int): The rows per batch, the last batch may be shorter.
+            columns (list): The output fields to return, in this order. None = all fields.
+            activity_filter (ActivityFilter): Only return records matching the filter.
+            sequence (int): Only return records with an ETag above this value.
+            numpy (bool): True = NumPy arrays with times as datetime64, see
+                get_array_converter. False = lists of the values iter_activities outputs.
+        Yields:
+            (dict): output field -> column
+        """
+        fields = None if columns is None else set(columns)
+        cursor, record_class, layout = self._execute_activities(
+            sequence, fields, activity_filter
+        )
+        plan = get_batch_plan(layout, columns, numpy)
+        for batch in iter_column_batches(cursor, plan, batch_size):
+            yield batch
+
+    def get_dataframe(self, columns=None, activity_filter=None, sequence=0,
+                      batch_size=DEFAULT_BATCH_SIZE):
+        """Get the Activity records above a sequence as a pandas DataFrame, built from
+        NumPy batches. Requires numpy and pandas.
+
+        Params:
+            columns (list): The output fields to return, in this order. None = all fields.
+            activity_filter (ActivityFilter): Only return records matching the filter.
+            sequence (int): Only return records with an ETag above this value.
+            batch_size (int): The rows to fetch and convert at a time.
+        Returns:
+            (pandas.DataFrame): The records, times as datetime64[s] (UTC).
+        """
+        fields = None if columns is None else set(columns)
+        cursor, record_class, layout = self._execute_activities(
+            sequence, fields, activity_filter
+        )
+        plan = get_batch_plan(layout, columns, numpy=True)
+        return build_dataframe(iter_column_batches(cursor, plan, batch_size), plan)
+
+    def _execute_activities(self, sequence=0, fields=None, activity_filter=None, enrich=False,
+                            enrich_operations=False, sort_field=None):
+        """Execute the Activity query of iter_activities.
+
+        Returns:
+            (tuple): (cursor, record class, RecordLayout)
+        """
+        conditions = ["ETag > ?"]
+        parameters = [sequence]
+        if activity_filter is not None:
+            filter_conditions, filter_parameters = activity_filter.get_conditions()
+            conditions.extend(filter_conditions)
+            parameters.extend(filter_parameters)
+
+        record_class = ActivityRecord
+        select_columns = self.get_select_columns("Activity", ActivityRecord, fields)
+        joins = []
+        if enrich or enrich_operations:
+            record_class = EnrichedActivityRecord
+            select_columns = self.get_select_columns(
+                "Activity", ActivityRecord, fields, table_alias="Activity"
+            )
+            enrichments = []
+            if enrich:
+                enrichments.append(("Packages", "Activity_PackageId", PACKAGES_JOIN))
+            if enrich_operations:
+                enrichments.append(("Operations", "ActivityOperation", OPERATIONS_JOIN))
+
+            for key, table_name, join in enrichments:
+                if fields is not None and key not in fields:
+                    continue
+                if not self.has_table(table_name):
+                    logging.warning("No {} table, {} are not added.".format(table_name, key))
+                    continue
+                select_columns += ", {}".format(key)
+                joins.append(join)
+
+        order_by = "ETag DESC"
+        if sort_field is not None:
+            select_columns += ', "Activity"."{}" AS _sort_key'.format(sort_field)
+            order_by = '"Activity"."{}", "Activity".ETag'.format(sort_field)
+
         query_str = """
-            SELECT rowid, *
+            SELECT {}
             FROM Activity
-            WHERE ETag > {}
-            ORDER BY ETag DESC
-        """.format(sequence)
-        for row in self.db_handler.iter_rows(query_str):
-            yield ActivityRecord(row)
+            {}
+            WHERE {}
+            ORDER BY {}
+        """.format(
+            select_columns,
+            "".join(joins),
+            " AND ".join(conditions),
+            order_by
+        )
+        cursor = self.db_handler.execute(query_str, parameters)
+        layout = record_class.get_layout(
+            cursor.description, fields, self.get_column_types("Activity")
+        )
+        return cursor, record_class, layout
 
+    def iter_summary(self, summary, activity_filter=None):
+        """Iterate the rows of a Summary, grouped and aggregated by SQLite so that only
+        the aggregated rows are read.
 
-class GenericRecord(dict):
-    def __init__(self, row):
-        self.update(row)
+        Params:
+            summary (Summary): The summary to run.
+            activity_filter (ActivityFilter): Only count the activities matching the filter.
+        Yields:
+            (dict): column name -> value, in the order of the group columns.
+        """
+        conditions = []
+        parameters = []
+        if activity_filter is not None:
+            conditions, parameters = activity_filter.get_conditions()
 
-    def as_ordered_dict(self):
-        """Reformat record"""
-        record = OrderedDict([])
-        record.update(self)
-        return record
+        for row in self.db_handler.iter_rows(summary.get_query(conditions), parameters):
+            yield row
 
 
-class ActivityOperationRecord(dict):
-    def __init__(self, row):
-        self.update(row)
+def _put_unless_stopped(batch_queue, item, stopped):
+    """Put an item on a bounded queue, giving up when the consumer stopped.
 
-    def as_ordered_dict(self):
-        """Reformat record"""
-        record = OrderedDict([
-            ("OperationOrder", self["OperationOrder"]),
-            ("Id", binascii.b2a_hex(self["Id"])),
-            ("OperationType", self["OperationType"]),
-            ("AppId", ujson.loads(self["AppId"])),
-            ("PackageIdHash", self["PackageIdHash"]),
-            ("AppActivityId", self["AppActivityId"]),
-            ("ActivityType", self["ActivityType"]),
-            ("ParentActivityId", self["ParentActivityId"]),
-            ("Tag", self["Tag"]),
-            ("Group", self["Group"]),
-            ("MatchId", self["MatchId"]),
-            ("LastModifiedTime", datetime_decode_1970_str(self["LastModifiedTime"])),
-            ("ExpirationTime", datetime_decode_1970_str(self["ExpirationTime"])),
-            ("Payload", ujson.loads(self["Payload"])),
-            ("Priority", self["Priority"]),
-            ("CreatedTime", datetime_decode_1970_str(self["CreatedTime"])),
-            ("Attachments", self["Attachments"]),
-            ("PlatformDeviceId", self["PlatformDeviceId"]),
-            ("CreatedInCloud", self["CreatedInCloud"]),
-            ("StartTime", datetime_decode_1970_str(self["StartTime"])),
-            ("EndTime", datetime_decode_1970_str(self["EndTime"])),
-            ("LastModifiedOnClient", self["LastModifiedOnClient"]),
-            ("CorrelationVector", self["CorrelationVector"]),
-            ("GroupAppActivityId", self["GroupAppActivityId"]),
-            ("ClipboardPayload", self["ClipboardPayload"]),
-            ("EnterpriseId", self["EnterpriseId"]),
-            ("OriginalPayload", self["OriginalPayload"]),
-            ("OriginalLastModifiedOnClient", self["OriginalLastModifiedOnClient"]),
-            ("ETag", self["ETag"])
-        ])
-
-        return record
-
-
-class PackageIdRecord(dict):
-    def __init__(self, row):
-        self.update(row)
+    Returns:
+        (bool): True = The item was queued.
+    """
+    while not stopped.is_set():
+        try:
+            batch_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
 
-    def as_ordered_dict(self):
-        """Reformat record"""
-        record = OrderedDict([
-            ("_rowid", self["rowid"]),
-            ("ActivityId", binascii.b2a_hex(self["ActivityId"])),
-            ("Platform", self["Platform"]),
-            ("PackageName", self["PackageName"]),
-            ("ExpirationTime", self["ExpirationTime"])
-        ])
 
-        return record
+class ActivityFilter(object):
+    """Activity record filters that are evaluated by SQLite."""
+    TIME_FIELDS = ["StartTime", "LastModifiedTime"]
 
+    def __init__(self, start=None, end=None, time_field="StartTime", app=None,
+                 activity_types=None):
+        """Create ActivityFilter
 
-class ActivityRecord(dict):
-    def __init__(self, row):
-        self.update(row)
+        Params:
+            start (int): Only records with a time_field at or after this (seconds since 1970).
+            end (int): Only records with a time_field at or before this (seconds since 1970).
+            time_field (unicode): The time column to filter on, StartTime or LastModifiedTime.
+            app (unicode): Only records with an AppId application containing this (case insensitive).
+            activity_types (list): Only records with one of these ActivityType values.
+        """
+        if time_field not in self.TIME_FIELDS:
+            raise Exception("{} is not a valid time field.".format(time_field))
+
+        self.start = start
+        self.end = end
+        self.time_field = time_field
+        self.app = app
+        self.activity_types = activity_types
+
+    def get_conditions(self):
+        """Get the WHERE conditions and their parameters.
+
+        Returns:
+            (list, list): The SQL conditions and the parameters they use.
+        """
+        conditions = []
+        parameters = []
+        if self.start is not None:
+            conditions.append("{} >= ?".format(self.time_field))
+            parameters.append(self.start)
+        if self.end is not None:
+            conditions.append("{} <= ?".format(self.time_field))
+            parameters.append(self.end)
+        if self.app:
+            # a malformed AppId does not match, rather than failing the whole query
+            conditions.append("""CASE WHEN json_valid(Activity.AppId) THEN EXISTS (
+                SELECT 1 FROM json_each(Activity.AppId)
+                WHERE instr(lower(json_extract(json_each.value, '$.application')), lower(?)) > 0
+            ) ELSE 0 END""")
+            parameters.append(self.app)
+        if self.activity_types:
+            conditions.append("ActivityType IN ({})".format(
+                ", ".join("?" * len(self.activity_types))
+            ))
+            parameters.extend(self.activity_types)
+
+        return conditions, parameters
+
+
+def _decode_guid(value):
+    """Decode a GUID column of a generic table or view, which may be NULL."""
+    if value is None:
+        return None
+    return binascii.b2a_hex(value)
+
+
+class RecordLayout(object):
+    """The column positions of a query, resolved once and shared by its records."""
+    __slots__ = ("columns", "fields", "types")
+
+    def __init__(self, columns, fields, types=None):
+        """Create RecordLayout
+
+        Params:
+            columns (dict): column name -> row index
+            fields (tuple): (output key, row index, decoder) for each output field
+            types (tuple): The declared type of each row index, None = unknown
+        """
+        self.columns = columns
+        self.fields = fields
+        self.types = types
+
+
+class GenericRecord(object):
+    """A row of a table, kept as the tuple returned by sqlite3.
+
+    Fields are decoded when they are output or first accessed with get_field.
+    """
+    __slots__ = ("_row", "_layout", "_table", "_decoded")
+
+    # (output key, column name, decoder), None = output every column as is
+    FIELDS = None
+
+    def __init__(self, row, layout, table=None):
+        self._row = row
+        self._layout = layout
+        self._table = table
+        self._decoded = None
+
+    @classmethod
+    def get_layout(cls, description, fields=None, column_types=None):
+        """Resolve the output fields of this record type against a cursor description.
+
+        Params:
+            description (tuple): The cursor.description of the query.
+            fields (set): Only output these fields. None = all fields.
+            column_types (dict): column name -> declared type of the table.
+        Returns:
+            (RecordLayout): The layout for the rows of the query.
+        """
+        columns = {}
+        for index, column in enumerate(description):
+            columns[column[0]] = index
+
+        if cls.FIELDS is None:
+            column_types = column_types or {}
+            field_specs = [
+                (name, index, _decode_guid if column_types.get(name) == "GUID" else None)
+                for name, index in columns.items()
+            ]
+        else:
+            field_specs = [
+                (key, columns[column], decoder)
+                for key, column, decoder in cls.FIELDS
+                if column in columns
+            ]
+
+        if fields is not None:
+            field_specs = [
+                field_spec for field_spec in field_specs
+                if field_spec[0] in fields
+            ]
+
+        types = None
+        if column_types:
+            types = tuple(
+                column_types.get(column[0], "INTEGER" if column[0] == "rowid" else None)
+                for column in description
+            )
+
+        return RecordLayout(columns, tuple(field_specs), types)
+
+    def __getitem__(self, key):
+        return self._row[self._layout.columns[key]]
+
+    def get(self, key, default=None):
+        index = self._layout.columns.get(key)
+        if index is None:
+            return default
+        return self._row[index]
+
+    def get_field(self, key):
+        """Get a decoded output field, the field is decoded on first access.
+
+        Params:
+            key (unicode): The output field name.
+        Returns:
+            The decoded value.
+        """
+        if self._decoded is None:
+            self._decoded = {}
+        elif key in self._decoded:
+            return self._decoded[key]
+
+        for field_key, index, decoder in self._layout.fields:
+            if field_key == key:
+                value = self._row[index]
+                if decoder is not None:
+                    value = decoder(value)
+                self._decoded[key] = value
+                return value
+
+        raise KeyError(key)
 
     def as_ordered_dict(self):
         """Reformat record"""
-        record = OrderedDict([
-            ("_rowid", self["rowid"]),
-            ("Id", binascii.b2a_hex(self["Id"])),
-            ("AppId", ujson.loads(self['AppId'])),
-            ("PackageIdHash", self["PackageIdHash"]),
-            ("AppActivityId", self["AppActivityId"]),
-            ("ActivityType", self["ActivityType"]),
-            ("ActivityStatus", self["ActivityStatus"]),
-            ("ParentActivityId", binascii.b2a_hex(self["ParentActivityId"])),
-            ("Tag", self["Tag"]),
-            ("Group", self["Group"]),
-            ("MatchId", self["MatchId"]),
-            ("LastModifiedTime", datetime_decode_1970_str(
-                self["LastModifiedTime"])
-             ),
-            ("ExpirationTime", datetime_decode_1970_str(
-                self["ExpirationTime"])
-             ),
-            ("Payload", ujson.loads(self['Payload'])),
-            ("Priority", self["Priority"]),
-            ("IsLocalOnly", self["IsLocalOnly"]),
-            ("PlatformDeviceId", self["PlatformDeviceId"]),
-            ("CreatedInCloud", self["CreatedInCloud"]),
-            ("StartTime", datetime_decode_1970_str(
-                self["StartTime"])
-             ),
-            ("EndTime", datetime_decode_1970_str(
-                self["EndTime"])
-             ),
-            ("LastModifiedOnClient", datetime_decode_1970_str(
-                self["LastModifiedOnClient"])
-             ),
-            ("GroupAppActivityId", self["GroupAppActivityId"]),
-            ("ClipboardPayload", self["ClipboardPayload"]),
-            ("EnterpriseId", self["EnterpriseId"]),
-            ("OriginalPayload", self["OriginalPayload"]),
-            ("OriginalLastModifiedOnClient", datetime_decode_1970_str(
-                self["OriginalLastModifiedOnClient"])
-             ),
-            ("ETag", self["ETag"])
-        ])
-
-        return record
+        row = self._row
+        return {
+            key: row[index] if decoder is None else decoder(row[index])
+            for key, index, decoder in self._layout.fields
+        }
+
+
+class ActivityOperationRecord(GenericRecord):
+    __slots__ = ()
+
+    FIELDS = (
+        ("OperationOrder", "OperationOrder", None),
+        ("Id", "Id", binascii.b2a_hex),
+        ("OperationType", "OperationType", None),
+        ("AppId", "AppId", ujson.loads),
+        ("PackageIdHash", "PackageIdHash", None),
+        ("AppActivityId", "AppActivityId", None),
+        ("ActivityType", "ActivityType", None),
+        ("ParentActivityId", "ParentActivityId", None),
+        ("Tag", "Tag", None),
+        ("Group", "Group", None),
+        ("MatchId", "MatchId", None),
+        ("LastModifiedTime", "LastModifiedTime", datetime_decode_1970_str),
+        ("ExpirationTime", "ExpirationTime", datetime_decode_1970_str),
+        ("Payload", "Payload", ujson.loads),
+        ("Priority", "Priority", None),
+        ("CreatedTime", "CreatedTime", datetime_decode_1970_str),
+        ("Attachments", "Attachments", None),
+        ("PlatformDeviceId", "PlatformDeviceId", None),
+        ("CreatedInCloud", "CreatedInCloud", None),
+        ("StartTime", "StartTime", datetime_decode_1970_str),
+        ("EndTime", "EndTime", datetime_decode_1970_str),
+        ("LastModifiedOnClient", "LastModifiedOnClient", None),
+        ("CorrelationVector", "CorrelationVector", None),
+        ("GroupAppActivityId", "GroupAppActivityId", None),
+        ("ClipboardPayload", "ClipboardPayload", None),
+        ("EnterpriseId", "EnterpriseId", None),
+        ("OriginalPayload", "OriginalPayload", None),
+        ("OriginalLastModifiedOnClient", "OriginalLastModifiedOnClient", None),
+        ("ETag", "ETag", None)
+    )
+
+
+class PackageIdRecord(GenericRecord):
+    __slots__ = ()
+
+    FIELDS = (
+        ("_rowid", "rowid", None),
+        ("ActivityId", "ActivityId", binascii.b2a_hex),
+        ("Platform", "Platform", None),
+        ("PackageName", "PackageName", None),
+        ("ExpirationTime", "ExpirationTime", None)
+    )
+
+
+def _decode_json_list(value):
+    """Decode a grouped JSON array, None when nothing was joined."""
+    if value is None:
+        return []
+    return ujson.loads(value)
+
+
+class ActivityRecord(GenericRecord):
+    __slots__ = ()
+
+    FIELDS = (
+        ("_rowid", "rowid", None),
+        ("Id", "Id", binascii.b2a_hex),
+        ("AppId", "AppId", ujson.loads),
+        ("PackageIdHash", "PackageIdHash", None),
+        ("AppActivityId", "AppActivityId", None),
+        ("ActivityType", "ActivityType", None),
+        ("ActivityStatus", "ActivityStatus", None),
+        ("ParentActivityId", "ParentActivityId", binascii.b2a_hex),
+        ("Tag", "Tag", None),
+        ("Group", "Group", None),
+        ("MatchId", "MatchId", None),
+        ("LastModifiedTime", "LastModifiedTime", datetime_decode_1970_str),
+        ("ExpirationTime", "ExpirationTime", datetime_decode_1970_str),
+        ("Payload", "Payload", ujson.loads),
+        ("Priority", "Priority", None),
+        ("IsLocalOnly", "IsLocalOnly", None),
+        ("PlatformDeviceId", "PlatformDeviceId", None),
+        ("CreatedInCloud", "CreatedInCloud", None),
+        ("StartTime", "StartTime", datetime_decode_1970_str),
+        ("EndTime", "EndTime", datetime_decode_1970_str),
+        ("LastModifiedOnClient", "LastModifiedOnClient", datetime_decode_1970_str),
+        ("GroupAppActivityId", "GroupAppActivityId", None),
+        ("ClipboardPayload", "ClipboardPayload", None),
+        ("EnterpriseId", "EnterpriseId", None),
+        ("OriginalPayload", "OriginalPayload", None),
+        ("OriginalLastModifiedOnClient", "OriginalLastModifiedOnClient", datetime_decode_1970_str),
+        ("ETag", "ETag", None)
+    )
+
+
+class EnrichedActivityRecord(ActivityRecord):
+    """An Activity record with the Packages and Operations joined to it."""
+    __slots__ = ()
+
+    FIELDS = ActivityRecord.FIELDS + (
+        ("Packages", "Packages", _decode_json_list),
+        ("Operations", "Operations", _decode_json_list)
+    )
@@ -0,0 +1,169 @@
+import binascii
+from winactivities.helpers import datetime_decode_1970_str
+from winactivities.columnar import DEFAULT_BATCH_SIZE
+
+
+def get_numpy():
+    """Import numpy, which is only required for NumPy batches and DataFrames."""
+    try:
+        import numpy
+    except ImportError:
+        raise Exception("numpy is required for NumPy batches.")
+    return numpy
+
+
+def get_pandas():
+    """Import pandas, which is only required for DataFrames."""
+    try:
+        import pandas
+    except ImportError:
+        raise Exception("pandas is required for DataFrames.")
+    return pandas
+
+
+def get_list_converter(decoder):
+    """Get the converter of a column of values into a list, decoded like the output
+    fields of a record.
+
+    Params:
+        decoder (function): The record decoder of the field, None = not decoded.
+    Returns:
+        (function): tuple of column values -> list
+    """
+    if decoder is None:
+        return list
+
+    def convert(values):
+        return [decoder(value) for value in values]
+    return convert
+
+
+def get_array_converter(np, decoder, declared_type):
+    """Get the converter of a column of values into a NumPy array.
+
+    Times are datetime64[s] (UTC) with NaT for 0 and NULL. INTEGER columns are int64
+    and REAL columns float64, an INTEGER column with NULLs is an object array. GUIDs are
+    hex strings and the other columns object arrays of the decoded values.
+
+    Params:
+        np (module): numpy
+        decoder (function): The record decoder of the field, None = not decoded.
+        declared_type (unicode): The declared SQLite type of the column.
+    Returns:
+        (function): tuple of column values -> numpy.ndarray
+    """
+    declared_type = declared_type or ""
+
+    def to_objects(values, count=None):
+        # fromiter does not unpack list values, such as a decoded AppId
+        return np.fromiter(values, dtype=object, count=len(values) if count is None else count)
+
+    if decoder is datetime_decode_1970_str or declared_type == "DATETIME":
+        def convert(values):
+            return np.array([value or None for value in values], dtype="datetime64[s]")
+    elif decoder is binascii.b2a_hex or declared_type == "GUID":
+        def convert(values):
+            return to_objects(
+                (None if value is None else binascii.b2a_hex(value).decode("ascii")
+                 for value in values),
+                len(values)
+            )
+    elif decoder is not None:
+        def convert(values):
+            return to_objects((decoder(value) for value in values), len(values))
+    elif "INT" in declared_type:
+        def convert(values):
+            if None in values:
+                return to_objects(values)
+            return np.array(values, dtype=np.int64)
+    elif "REAL" in declared_type or "FLOA" in declared_type or "DOUB" in declared_type:
+        def convert(values):
+            return np.array(values, dtype=np.float64)
+    else:
+        convert = to_objects
+
+    return convert
+
+
+def get_batch_plan(layout, columns=None, numpy=False):
+    """Get the (output key, row index, converter) of each batch column.
+
+    Params:
+        layout (RecordLayout): The layout of the query.
+        columns (list): The output keys in batch order. None = all output fields.
+        numpy (bool): True = convert columns to NumPy arrays, False = to lists.
+    Returns:
+        (list): (output key, row index, converter)
+    """
+    fields = dict((key, (index, decoder)) for key, index, decoder in layout.fields)
+    if columns is None:
+        columns = [key for key, index, decoder in layout.fields]
+    else:
+        missing = [key for key in columns if key not in fields]
+        if missing:
+            raise Exception("Unknown columns: {}".format(", ".join(missing)))
+
+    np = get_numpy() if numpy else None
+    plan = []
+    for key in columns:
+        index, decoder = fields[key]
+        if np is None:
+            converter = get_list_converter(decoder)
+        else:
+            declared_type = layout.types[index] if layout.types else None
+            converter = get_array_converter(np, decoder, declared_type)
+        plan.append((key, index, converter))
+
+    return plan
+
+
+def iter_column_batches(cursor, plan, batch_size=DEFAULT_BATCH_SIZE):
+    """Fetch the rows of a query in batches and transpose them into columns.
+
+    Params:
+        cursor (sqlite3.Cursor): The executed query.
+        plan (list): (output key, row index, converter) of each column, from get_batch_plan.
+        batch_size (int): The rows per batch.
+    Yields:
+        (dict): output key -> column, all columns of a batch have the same length.
+    """
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+
+        row_columns = list(zip(*rows))
+        yield dict(
+            (key, converter(row_columns[index])) for key, index, converter in plan
+        )
+
+
+def build_dataframe(batches, plan):
+    """Concatenate NumPy batches into a pandas DataFrame.
+
+    Params:
+        batches (iterator): NumPy batches from iter_column_batches.
+        plan (list): The plan of the batches.
+    Returns:
+        (pandas.DataFrame): One column per batch column, in plan order.
+    """
+    pd = get_pandas()
+    np = get_numpy()
+
+    column_arrays = dict((key, []) for key, index, converter in plan)
+    for batch in batches:
+        for key, array in batch.items():
+            column_arrays[key].append(array)
+
+    data = {}
+    for key, index, converter in plan:
+        arrays = column_arrays.pop(key)
+        if not arrays:
+            data[key] = converter(())
+        elif len(arrays) == 1:
+            data[key] = arrays[0]
+        else:
+            # int64 and object batches of a column with NULLs concatenate to object
+            data[key] = np.concatenate(arrays)
+
+    return pd.DataFrame(data, columns=[key for key, index, converter in plan])
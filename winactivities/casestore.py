@@ -0,0 +1,152 @@
+import ujson
+import sqlite3
+import logging
+import binascii
+
+DEFAULT_CASE_BATCH_SIZE = 50000
+
+CASE_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS Activity (
+    source TEXT NOT NULL,
+    user TEXT,
+    cdp_location TEXT,
+    Id TEXT NOT NULL,
+    ETag INTEGER NOT NULL,
+    ActivityType INTEGER,
+    StartTime INTEGER,
+    EndTime INTEGER,
+    LastModifiedTime INTEGER,
+    AppName TEXT,
+    Record TEXT NOT NULL,
+    UNIQUE (Id, ETag, source)
+);
+CREATE INDEX IF NOT EXISTS Activity_StartTime ON Activity (StartTime);
+CREATE INDEX IF NOT EXISTS Activity_AppName ON Activity (AppName);
+CREATE INDEX IF NOT EXISTS Activity_Id_ETag ON Activity (Id, ETag);
+CREATE VIEW IF NOT EXISTS UniqueActivity AS
+    SELECT * FROM Activity
+    WHERE rowid IN (SELECT MIN(rowid) FROM Activity GROUP BY Id, ETag);
+"""
+
+INSERT_QUERY = """
+    INSERT OR REPLACE INTO Activity (
+        source, user, cdp_location, Id, ETag, ActivityType, StartTime, EndTime,
+        LastModifiedTime, AppName, Record
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def get_time(value):
+    """Get a time column to store, NULL for the unset time 0 rather than 1970-01-01."""
+    if not value:
+        return None
+    return value
+
+
+def get_app_name(app_id):
+    """Get the first application name of an AppId JSON column."""
+    if not app_id:
+        return None
+
+    try:
+        applications = ujson.loads(app_id)
+    except ValueError:
+        return None
+
+    for application in applications:
+        if application.get("application"):
+            return application["application"]
+
+    return None
+
+
+class CaseStoreSink(object):
+    """Writes activity records into a single SQLite case database.
+
+    Records are inserted with executemany, a batch per transaction. Each
+    activity is unique on (Id, ETag, source), so collecting the same source
+    again replaces its rows instead of duplicating them. The UniqueActivity
+    view returns one row per (Id, ETag) across all sources.
+    """
+    # the fields the case store columns are built from
+    REQUIRED_FIELDS = frozenset([
+        "Id", "ETag", "ActivityType", "StartTime", "EndTime", "LastModifiedTime", "AppId"
+    ])
+
+    def __init__(self, location, source=None, batch_size=DEFAULT_CASE_BATCH_SIZE):
+        """Create CaseStoreSink
+
+        Params:
+            location (unicode): The case database, created if it does not exist.
+            source (unicode): The source the records come from (database or volume), records
+                with a _source field use that instead.
+            batch_size (int): The number of records to insert per transaction.
+        """
+        self.location = location
+        self.source = source
+        self.batch_size = batch_size
+        self.broken_pipe = False
+        self.records_written = 0
+        self.rows_written = 0
+        self._rows = []
+
+        self._connection = sqlite3.connect(self.location)
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+        self._connection.executescript(CASE_STORE_SCHEMA)
+
+    def write_record(self, record, extra=None):
+        """Write an activity record.
+
+        Params:
+            record (ActivityRecord): The record.
+            extra (dict): Additional fields, _source, _user and _cpd_location are used for the source.
+        """
+        extra = extra or {}
+        user = extra.get("_user")
+        cdp_location = extra.get("_cpd_location")
+        source = extra.get("_source", self.source)
+        if user is not None:
+            source = "{}|{}|{}".format(source, user, cdp_location)
+
+        formatted_record = record.as_ordered_dict()
+        formatted_record.update(extra)
+
+        self._rows.append((
+            source, user, cdp_location,
+            binascii.b2a_hex(record["Id"]).decode("ascii"),
+            record["ETag"],
+            record.get("ActivityType"),
+            get_time(record.get("StartTime")),
+            get_time(record.get("EndTime")),
+            get_time(record.get("LastModifiedTime")),
+            get_app_name(record.get("AppId")),
+            ujson.dumps(formatted_record)
+        ))
+        self.records_written += 1
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+
+        with self._connection:
+            self._connection.executemany(
+                INSERT_QUERY, self._rows
+            )
+        self.rows_written += len(self._rows)
+        self._rows = []
+
+    def close(self):
+        self.flush()
+        self._connection.close()
+        logging.info("Wrote {} records to {}".format(
+            self.rows_written, self.location
+        ))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,242 @@
+import os
+import ujson
+import logging
+import binascii
+from winactivities.helpers import datetime_decode_1970_str
+
+COLUMNAR_FORMATS = ["parquet", "arrow"]
+DEFAULT_BATCH_SIZE = 65536
+
+
+def _convert_hex(value):
+    if value is None:
+        return None
+    return binascii.b2a_hex(value).decode("ascii")
+
+
+def _convert_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    elif isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return str(value)
+
+
+def _convert_timestamp(value):
+    # 0 is how ActivitiesCache stores an unset time, not 1970-01-01
+    if not value:
+        return None
+    return int(value)
+
+
+def _convert_value(value):
+    return value
+
+
+def get_column_type(pa, decoder, declared_type):
+    """Get the Arrow type of an output field and the converter for its column values.
+
+    Params:
+        pa (module): pyarrow
+        decoder (function): The record decoder of the field, None = not decoded.
+        declared_type (unicode): The declared SQLite type of the column.
+    Returns:
+        (tuple): (pyarrow.DataType, converter)
+    """
+    declared_type = declared_type or ""
+    if decoder is datetime_decode_1970_str or declared_type == "DATETIME":
+        return pa.timestamp("s", tz="UTC"), _convert_timestamp
+    elif decoder is binascii.b2a_hex or declared_type == "GUID":
+        return pa.string(), _convert_hex
+    elif decoder is ujson.loads:
+        # JSON columns (AppId, Payload) are kept as their JSON text
+        return pa.string(), _convert_text
+    elif "INT" in declared_type:
+        return pa.int64(), _convert_value
+    elif "REAL" in declared_type or "FLOA" in declared_type or "DOUB" in declared_type:
+        return pa.float64(), _convert_value
+    elif "BLOB" in declared_type:
+        return pa.binary(), _convert_value
+
+    return pa.string(), _convert_text
+
+
+class _TableWriter(object):
+    """Gathers the records of one table into record batches and writes them to a file."""
+    def __init__(self, pa, location, file_format, batch_size, layout, extra_keys):
+        self._pa = pa
+        self.location = location
+        self.batch_size = batch_size
+        self.rows_written = 0
+
+        schema_fields = []
+        self._keys = []
+        for key, index, decoder in layout.fields:
+            declared_type = layout.types[index] if layout.types else None
+            column_type, converter = get_column_type(pa, decoder, declared_type)
+            schema_fields.append(pa.field(key, column_type))
+            self._keys.append(key)
+        self._extra_keys = list(extra_keys)
+        for key in self._extra_keys:
+            schema_fields.append(pa.field(key, pa.string()))
+        self.schema = pa.schema(schema_fields)
+
+        self._plans = {}
+        self._columns = [[] for _ in schema_fields]
+        self._row_count = 0
+
+        if file_format == "parquet":
+            import pyarrow.parquet
+            self._writer = pyarrow.parquet.ParquetWriter(
+                self.location, self.schema
+            )
+        else:
+            import pyarrow.ipc
+            self._writer = pyarrow.ipc.new_file(
+                self.location, self.schema
+            )
+
+    def _get_plan(self, layout):
+        """Get the (column, row index, converter) of each schema field for a layout. Databases
+        with a different schema version output nulls for the fields they do not have."""
+        plan = self._plans.get(layout)
+        if plan is None:
+            fields = {}
+            for key, index, decoder in layout.fields:
+                fields[key] = (index, decoder)
+
+            plan = []
+            for column_index, key in enumerate(self._keys):
+                if key not in fields:
+                    plan.append((column_index, None, None))
+                    continue
+
+                index, decoder = fields[key]
+                declared_type = layout.types[index] if layout.types else None
+                column_type, converter = get_column_type(
+                    self._pa, decoder, declared_type
+                )
+                plan.append((column_index, index, converter))
+
+            missing = set(fields.keys()) - set(self._keys)
+            if missing:
+                logging.warning("Fields not in the {} schema are not written: {}".format(
+                    self.location, ", ".join(sorted(missing))
+                ))
+
+            self._plans[layout] = plan
+
+        return plan
+
+    def append(self, record, extra):
+        row = record._row
+        columns = self._columns
+        for column_index, index, converter in self._get_plan(record._layout):
+            if index is None:
+                columns[column_index].append(None)
+            else:
+                columns[column_index].append(converter(row[index]))
+
+        offset = len(self._keys)
+        for extra_index, key in enumerate(self._extra_keys):
+            value = extra.get(key) if extra else None
+            columns[offset + extra_index].append(_convert_text(value))
+
+        self._row_count += 1
+        if self._row_count >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._row_count:
+            return
+
+        arrays = [
+            self._pa.array(column, type=field.type)
+            for column, field in zip(self._columns, self.schema)
+        ]
+        batch = self._pa.RecordBatch.from_arrays(
+            arrays, schema=self.schema
+        )
+        self._writer.write_batch(batch)
+        self.rows_written += self._row_count
+
+        self._columns = [[] for _ in self.schema]
+        self._row_count = 0
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+
+class ColumnarSink(object):
+    """Writes records as typed Arrow record batches to Parquet or Arrow IPC files.
+
+    Memory use is bounded by the batch size. pyarrow is only imported when a
+    ColumnarSink is created.
+    """
+    def __init__(self, location, file_format="parquet", batch_size=DEFAULT_BATCH_SIZE,
+                 split_tables=False):
+        """Create ColumnarSink
+
+        Params:
+            location (unicode): The output file.
+            file_format (unicode): parquet or arrow
+            batch_size (int): The number of records per record batch.
+            split_tables (bool): True = Write each table to its own file, named
+                <location name>.<table><location extension>.
+        """
+        if file_format not in COLUMNAR_FORMATS:
+            raise Exception("{} is not a valid columnar format.".format(file_format))
+
+        try:
+            import pyarrow
+        except ImportError:
+            raise Exception("pyarrow is required for the {} output format.".format(file_format))
+
+        self._pa = pyarrow
+        self.location = location
+        self.file_format = file_format
+        self.batch_size = batch_size
+        self.split_tables = split_tables
+        self.broken_pipe = False
+        self.records_written = 0
+        self._tables = {}
+
+    def get_table_location(self, table_name):
+        if not self.split_tables:
+            return self.location
+
+        root, extension = os.path.splitext(self.location)
+        return "{}.{}{}".format(root, table_name, extension)
+
+    def write_record(self, record, extra=None):
+        """Write a record.
+
+        Params:
+            record (GenericRecord): The record.
+            extra (dict): Additional string fields, such as _user and _cpd_location.
+        """
+        table_name = record._table or "Activity"
+        table_writer = self._tables.get(table_name)
+        if table_writer is None:
+            table_writer = _TableWriter(
+                self._pa, self.get_table_location(table_name), self.file_format,
+                self.batch_size, record._layout, extra.keys() if extra else []
+            )
+            self._tables[table_name] = table_writer
+
+        table_writer.append(record, extra)
+        self.records_written += 1
+
+    def close(self):
+        for table_name, table_writer in self._tables.items():
+            table_writer.close()
+            logging.info("Wrote {} {} records to {}".format(
+                table_writer.rows_written, table_name, table_writer.location
+            ))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,7 +1,35 @@
+import os
 import string
 import _string
 import sqlite3
 import datetime
+import functools
+import urllib.parse
+
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+DEFAULT_CACHE_SIZE = -64 * 1024
+DEFAULT_TEMP_STORE = "MEMORY"
+
+
+def get_sqlite_uri(location):
+    """Get the SQLite file: URI of a database location.
+
+    The URI has an empty authority, so a UNC path (\\\\server\\share\\...) becomes
+    file:////server/share/... rather than a server name that SQLite rejects, and
+    characters such as ? and # in the path are escaped.
+
+    Params:
+        location (unicode): The database file.
+    Returns:
+        (unicode): The URI, without query parameters.
+    """
+    path = os.path.abspath(location)
+    if os.sep != "/":
+        path = path.replace(os.sep, "/")
+    if not path.startswith("/"):
+        # a drive letter path, C:/...
+        path = "/" + path
+    return "file://" + urllib.parse.quote(path, safe="/:")
 
 
 def dict_factory(cursor, row):
@@ -11,25 +39,59 @@ def dict_factory(cursor, row):
     return d
 
 
+EPOCH_1970 = datetime.datetime(1970, 1, 1)
+
+
 def datetime_decode_1970_str(datetime_int):
     if datetime_int == 0:
         return 0
 
     if datetime_int:
+        if type(datetime_int) is int:
+            # whole seconds, only the date part needs datetime and it repeats
+            # for every record of the same day
+            days, seconds = divmod(datetime_int, 86400)
+            hours, seconds = divmod(seconds, 3600)
+            minutes, seconds = divmod(seconds, 60)
+            return "%s %02d:%02d:%02d" % (
+                _date_decode_1970_isoformat(days), hours, minutes, seconds
+            )
+
         return datetime_decode_1970(datetime_int).isoformat(" ")
 
     return None
 
 
+@functools.lru_cache(maxsize=16384)
+def _date_decode_1970_isoformat(days):
+    return (EPOCH_1970 + datetime.timedelta(days=days)).date().isoformat()
+
+
 def datetime_decode_1970(datetime_int):
     time_delta = datetime.timedelta(
         seconds=datetime_int
     )
 
-    orig_datetime = datetime.datetime(1970, 1, 1)
-    new_datetime = orig_datetime + time_delta
+    return EPOCH_1970 + time_delta
+
+
+def datetime_encode_1970(datetime_str):
+    """Get the seconds since 1970 of a "YYYY-MM-DD[ HH:MM:SS]" string, as stored in the
+    ActivitiesCache.db time columns (UTC)."""
+    for datetime_format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            new_datetime = datetime.datetime.strptime(
+                datetime_str, datetime_format
+            )
+        except ValueError:
+            continue
+
+        time_delta = new_datetime - EPOCH_1970
+        return time_delta.days * 86400 + time_delta.seconds
 
-    return new_datetime
+    raise ValueError("{} is not a valid datetime (YYYY-MM-DD[ HH:MM:SS]).".format(
+        datetime_str
+    ))
 
 
 class CustomStringFormatter(string.Formatter):
@@ -105,20 +167,198 @@ class CustomStringFormatter(string.Formatter):
             return value
 
 
+class CompiledTemplate(object):
+    """An output template parsed once into literal and field access steps.
+
+    Renders the same output as CustomStringFormatter, including rendering
+    fields that cannot be resolved as the default value, without re-parsing
+    the template for every record.
+    """
+    def __init__(self, template, default_value='', recursion_depth=2):
+        """Create CompiledTemplate
+
+        Params:
+            template (unicode): The output template.
+            default_value (unicode): The value used for missing fields.
+            recursion_depth (int): The maximum nesting of format specs.
+        """
+        self.template = template
+        self._default_value = default_value
+        self._steps = []
+        field_names = set()
+
+        for literal_text, field_name, format_spec, conversion in \
+                _string.formatter_parser(template):
+            if field_name is None:
+                self._steps.append(
+                    (literal_text, None, None, None, None)
+                )
+                continue
+
+            if recursion_depth <= 0:
+                raise ValueError('Max string recursion exceeded')
+
+            first, rest = _string.formatter_field_name_split(
+                field_name
+            )
+            if isinstance(first, str):
+                field_names.add(first)
+
+            if "{" in format_spec or "}" in format_spec:
+                # the format spec has its own fields, compile it as well
+                format_spec = CompiledTemplate(
+                    format_spec, default_value=default_value,
+                    recursion_depth=recursion_depth-1
+                )
+                field_names.update(format_spec.field_names)
+
+            self._steps.append(
+                (literal_text, first, list(rest), conversion, format_spec)
+            )
+
+        # the top level record fields the template references
+        self.field_names = frozenset(field_names)
+
+    def render(self, values):
+        """Render the template for a record.
+
+        Params:
+            values (dict): The field values of the record.
+        Returns:
+            (unicode): The formatted output.
+        """
+        result = []
+        for literal_text, first, rest, conversion, format_spec in self._steps:
+            # output the literal text
+            if literal_text:
+                result.append(literal_text)
+
+            if first is None:
+                continue
+
+            try:
+                if not isinstance(first, str):
+                    raise KeyError(first)
+
+                obj = values.get(first, self._default_value)
+                for is_attr, i in rest:
+                    if is_attr:
+                        obj = getattr(obj, i)
+                    else:
+                        obj = obj[i]
+            except Exception as error:
+                obj = ''
+
+            if conversion is not None:
+                obj = _BASE_FORMATTER.convert_field(obj, conversion)
+
+            if isinstance(format_spec, CompiledTemplate):
+                result.append(format(obj, format_spec.render(values)))
+            else:
+                result.append(format(obj, format_spec))
+
+        return ''.join(result)
+
+    def format(self, **kwargs):
+        return self.render(kwargs)
+
+
+_BASE_FORMATTER = string.Formatter()
+
+
+@functools.lru_cache(maxsize=64)
+def compile_template(template, default_value=''):
+    """Get the CompiledTemplate for a template string.
+
+    Params:
+        template (unicode): The output template.
+        default_value (unicode): The value used for missing fields.
+    Returns:
+        (CompiledTemplate): The compiled template, cached by template string.
+    """
+    return CompiledTemplate(
+        template, default_value=default_value
+    )
+
+
 class DbHandler(object):
-    def __init__(self, **kwargs):
+    """Manages a single read-only connection to a database for its lifetime."""
+    def __init__(self, database, read_only=True, mmap_size=DEFAULT_MMAP_SIZE,
+                 cache_size=DEFAULT_CACHE_SIZE, temp_store=DEFAULT_TEMP_STORE, image=None,
+                 **kwargs):
+        """Create DbHandler
+
+        Params:
+            database (unicode): The database location.
+            image (bytes): The database contents to open in memory instead of the
+                database location, requires Python 3.11 or later.
+            read_only (bool): True = Open the database with a mode=ro URI.
+            mmap_size (int): PRAGMA mmap_size, the bytes of the database to memory map.
+            cache_size (int): PRAGMA cache_size, negative values are KiB.
+            temp_store (unicode): PRAGMA temp_store.
+            kwargs: Other sqlite3.connect arguments.
+        """
+        self.database = database
+        self.read_only = read_only
+        self.pragmas = [
+            ("mmap_size", mmap_size),
+            ("cache_size", cache_size),
+            ("temp_store", temp_store)
+        ]
         self.properties = kwargs
+        self.image = image
+        self._connection = None
 
     def get_connection(self):
-        return sqlite3.connect(
-            **self.properties
-        )
+        if self._connection is None:
+            if self.image is not None:
+                self._connection = sqlite3.connect(
+                    ":memory:", **self.properties
+                )
+                if not hasattr(self._connection, "deserialize"):
+                    raise Exception("Opening a database image requires Python 3.11 or later.")
+
+                self._connection.deserialize(self.image)
+                if self.read_only:
+                    self._connection.execute("PRAGMA query_only = ON")
+            elif self.read_only:
+                location = get_sqlite_uri(self.database) + "?mode=ro"
+                self._connection = sqlite3.connect(
+                    location, uri=True, **self.properties
+                )
+            else:
+                self._connection = sqlite3.connect(
+                    self.database, **self.properties
+                )
+
+            for pragma, value in self.pragmas:
+                if value is not None:
+                    self._connection.execute(
+                        "PRAGMA {} = {}".format(pragma, value)
+                    )
+
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def execute(self, query, parameters=()):
+        """Execute a query and get the cursor, rows are returned as tuples."""
+        cursor = self.get_connection().cursor()
+        cursor.execute(query, parameters)
+        return cursor
 
-    def iter_rows(self, query):
-        connection = self.get_connection()
-        connection.row_factory = dict_factory
-        cursor = connection.cursor()
-        cursor.execute(query)
+    def iter_rows(self, query, parameters=()):
+        cursor = self.execute(query, parameters)
+        cursor.row_factory = dict_factory
 
         for row in cursor:
             yield row
@@ -1,12 +1,34 @@
 import os
+import time
 import ujson
+import queue
 import shutil
+import functools
+import threading
 import pytsk3
 import logging
 import tempfile
+import multiprocessing
 import datetime
-from winactivities.helpers import CustomStringFormatter
-from winactivities.activities import ActivitiesDb
+from winactivities.helpers import compile_template
+from winactivities.activities import ActivitiesDb, iter_activity_versions
+from winactivities.wal import get_database_image
+from winactivities.output import OutputSink, format_record
+from winactivities.sharded import ShardedSink
+from winactivities.stats import Stats, RecordTimer
+from winactivities.timeline import merge_sorted, iter_external_sorted, iter_keyed_records
+from winactivities.summary import iter_keyed_rows, iter_merged_rows
+
+
+ACTIVITIES_CACHE_NAME = "ActivitiesCache.db"
+# database and WAL bytes of a user read into memory with in_memory, larger sets are extracted
+DEFAULT_MEMORY_LIMIT = 1024 * 1024 * 1024
+# extraction sets to extract ahead of decoding, and output batches to decode ahead of writing
+PIPELINE_EXTRACT_AHEAD = 1
+PIPELINE_QUEUE_SIZE = 16
+PIPELINE_BATCH_SIZE = 1000
+PIPELINE_POLL_SECONDS = 0.1
+CDP_SETTINGS_NAME = "CDPGlobalSettings.cdp"
 
 
 class SetMeta(object):
@@ -16,51 +38,84 @@ class SetMeta(object):
 
 
 class ExtractionSet(object):
-    def __init__(self, temp_base, username, cdp_location):
+    def __init__(self, temp_base, username, cdp_location, in_memory=False):
         temp_location = "{}-{}".format(username, cdp_location)
         temp_location = os.path.join(
             temp_base, temp_location
         )
-        logging.info("Temp location: {}".format(temp_location))
 
         self.set_metadata = SetMeta(
             username, cdp_location
         )
         self.set_extract_location = temp_location
+        self.in_memory = in_memory
 
         self.files = []
+        self.meta_addresses = {}
+        # file name -> contents, for sets read into memory
+        self.file_data = {}
+        if not self.in_memory:
+            self.make_extract_location()
+
+    def make_extract_location(self):
+        logging.info("Temp location: {}".format(self.set_extract_location))
         if not os.path.isdir(self.set_extract_location):
-            os.mkdir(self.set_extract_location)
+            os.makedirs(self.set_extract_location, exist_ok=True)
 
     def extract_file(self, tsk_file, source_path):
         if not tsk_file.info.meta.size > 0:
             return
 
-        file_name = tsk_file.info.name.name.decode('utf-8')
+        # files opened by inode have no name
+        file_name = source_path.rsplit("/", 1)[-1]
         temp_file_name = os.path.join(
             self.set_extract_location,
             file_name
         )
-        logging.info("Extracting: {} -> {}".format(source_path, temp_file_name))
 
-        with open(temp_file_name, "wb") as fh:
-            data = tsk_file.read_random(
+        if self.in_memory:
+            logging.info("Reading into memory: {}".format(source_path))
+            self.file_data[file_name] = tsk_file.read_random(
                 0, tsk_file.info.meta.size
             )
-            fh.write(data)
+        else:
+            logging.info("Extracting: {} -> {}".format(source_path, temp_file_name))
+            with open(temp_file_name, "wb") as fh:
+                data = tsk_file.read_random(
+                    0, tsk_file.info.meta.size
+                )
+                fh.write(data)
 
         self.files.append(temp_file_name)
+        self.meta_addresses[file_name] = tsk_file.info.meta.addr
 
     def get_activities_location(self):
         for location in self.files:
             if location.endswith("ActivitiesCache.db"):
                 return location
 
+    def get_wal_location(self):
+        for location in self.files:
+            if location.endswith("ActivitiesCache.db-wal"):
+                return location
+
+    def get_activities_data(self):
+        """Get the database contents of a set read into memory, None if it was not found."""
+        return self.file_data.get(ACTIVITIES_CACHE_NAME)
+
+    def get_wal_data(self):
+        return self.file_data.get(ACTIVITIES_CACHE_NAME + "-wal")
+
+    def release(self):
+        """Drop the file contents of a set read into memory once it is opened."""
+        self.file_data = {}
+
 
 class TempFileManager(object):
-    def __init__(self, temp_location=None, cleanup=False):
+    def __init__(self, temp_location=None, cleanup=False, in_memory=False):
         self.temp_location = temp_location
         self.cleanup = cleanup
+        self.in_memory = in_memory
         self.extraction_sets = []
 
         if not self.temp_location:
@@ -71,26 +126,114 @@ class TempFileManager(object):
             )
             self.temp_location = temp_loc
 
-    def get_extraction_set(self, username, cdp_location):
+    def get_extraction_set(self, username, cdp_location, in_memory=None):
+        if in_memory is None:
+            in_memory = self.in_memory
+
         extraction_set = ExtractionSet(
-            self.temp_location, username, cdp_location
+            self.temp_location, username, cdp_location, in_memory
         )
         self.extraction_sets.append(
             extraction_set
         )
         return extraction_set
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.cleanup:
+    def close(self):
+        """Remove the temp folder if cleanup is set. Sets read into memory write no files,
+        so there may be nothing to remove."""
+        self.extraction_sets = []
+        if self.cleanup and os.path.isdir(self.temp_location):
+            logging.info("Removing temp location: {}".format(self.temp_location))
             shutil.rmtree(
                 self.temp_location
             )
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# the VolumeProcessor of a worker process, the volume is opened once for all of its jobs
+_worker_processor = None
+
+
+def _init_extraction_worker(source, processor_options):
+    """Pool initializer, opens the volume and its file system once per worker process.
+
+    Params:
+        source (unicode): The volume path.
+        processor_options (dict): VolumeProcessor options.
+    """
+    global _worker_processor
+    logging.info("Opening {} in worker process {}".format(source, os.getpid()))
+    _worker_processor = VolumeProcessor(
+        pytsk3.Img_Info(source), description=source,
+        **processor_options
+    )
+
+
+def _process_extraction_set(job):
+    """Extract and decode one (username, cdp_location) set in a worker process.
+
+    The worker reuses the volume it opened in _init_extraction_worker and writes its
+    formatted output to a temp file that the parent copies in order and removes. The
+    file is in the extraction set folder, or in the system temp folder for sets read
+    into memory.
+
+    Params:
+        job (tuple): (username, cdp_location, file_locations)
+    Returns:
+        (tuple): (output location, state key, state entry, Stats or None)
+    """
+    username, cdp_location, file_locations = job
+    processor = _worker_processor
+    if processor.stats is not None:
+        # the stats of this set only, the parent merges the stats of every set
+        processor.stats = Stats()
+    extraction_set = processor.temp_manager.get_extraction_set(
+        username, cdp_location
+    )
+    processor._extract_files(
+        extraction_set, file_locations
+    )
+
+    # sets read into memory write nothing to the temp location
+    output_directory = None
+    if not extraction_set.in_memory:
+        output_directory = extraction_set.set_extract_location
+    output_handle, output_location = tempfile.mkstemp(
+        suffix=".txt", dir=output_directory
+    )
+    os.close(output_handle)
+    with OutputSink(output_location) as output_sink:
+        for output in processor._iter_output(extraction_set, username, cdp_location):
+            output_sink.write(output)
+    if processor.stats is not None:
+        processor.stats.add_sink(
+            processor._get_stats_source(username, cdp_location), "write",
+            output_sink, (0.0, 0, 0)
+        )
+
+    state_key = None
+    state_entry = None
+    if processor.state is not None:
+        state_key = processor._get_state_key(extraction_set, username, cdp_location)
+        state_entry = processor.state.entries.get(state_key)
+
+    processor.temp_manager.extraction_sets = []
+    return output_location, state_key, state_entry, processor.stats
+
 
 class VolumeProcessor(object):
     """A class to process the logical volume."""
     def __init__(self, file_io, description=u"", temp_location=None, cleanup=False,
-                 output_template=False, dump_db=False):
+                 output_template=False, dump_db=False, dump_threads=1, fields=None,
+                 activity_filter=None, enrich=False, enrich_operations=False,
+                 users=None, state=None, wal_index=False, wal_history=False, extra=None,
+                 stats=None, discover=False, source=None, workers=1, ordered=False,
+                 sort_field=None, in_memory=False, memory_limit=DEFAULT_MEMORY_LIMIT):
         """Create LogicalEnumerator
 
         Params:
@@ -100,6 +243,28 @@ class VolumeProcessor(object):
             cleanup (bool): Remove the temp folder after processesing
             output_template (unicode): The output template.
             dump_db (bool): True = Dump all database tables.
+            dump_threads (int): The number of tables to dump at the same time.
+            fields (set): The fields to output. None = the template fields, otherwise all.
+            activity_filter (ActivityFilter): Only output activities matching the filter.
+            enrich (bool): True = Add the Packages of each activity.
+            enrich_operations (bool): True = Add the pending upload Operations of each activity.
+            users (list): Only process these users. None = all users.
+            state (StateFile): Only output activities newer than the state and update it.
+            wal_index (bool): True = Apply the WAL through a WalIndex instead of SQLite.
+            wal_history (bool): True = Output every activity version in the WAL commits.
+            extra (dict): Additional fields to output with every record, such as _source.
+            stats (Stats): Time the stages of each user database. None = no timing.
+            discover (bool): True = Find the databases by walking the directory metadata of the
+                whole volume once instead of resolving the CDPGlobalSettings.cdp paths of each user.
+            source (unicode): The volume path, needed by worker processes to reopen the volume.
+            workers (int): The number of worker processes to extract and decode with.
+            ordered (bool): True = Output the worker results in user order.
+            sort_field (unicode): Output the activities of all users merged in the order of
+                this Activity column. None = each database in descending ETag order.
+            in_memory (bool): True = Read the database and WAL of each user into memory and
+                open them with the WAL applied, without writing them to temp_location.
+            memory_limit (int): The most database and WAL bytes of a user to read into
+                memory, larger sets are extracted to temp_location. None = no limit.
         """
         self.file_io = file_io
         self.description = description
@@ -108,14 +273,424 @@ class VolumeProcessor(object):
         )
         self.temp_manager = TempFileManager(
             temp_location=temp_location,
-            cleanup=cleanup
+            cleanup=cleanup,
+            in_memory=in_memory
         )
         self.output_template = output_template
         self.dump_db = dump_db
+        self.dump_threads = dump_threads
+        self.fields = fields
+        self.activity_filter = activity_filter
+        self.enrich = enrich
+        self.enrich_operations = enrich_operations
+        self.users = users
+        self.state = state
+        self.wal_index = wal_index
+        self.wal_history = wal_history
+        self.extra = extra or {}
+        self.stats = stats
+        self.discover = discover
+        self.source = source
+        self.workers = workers
+        self.ordered = ordered
+        self.sort_field = sort_field
+        self.in_memory = in_memory
+        self.memory_limit = memory_limit
+
+    def process(self, output_sink=None):
+        """Extract and process files from a logical volume.
+
+        Params:
+            output_sink (OutputSink): Where to write the output, an OutputSink, ColumnarSink
+                or CaseStoreSink. None = a new stdout sink.
+        """
+        if output_sink is None:
+            with OutputSink() as output_sink:
+                self.process(output_sink)
+            return
+
+        with self.temp_manager:
+            self._process(output_sink)
+
+    def _process(self, output_sink):
+        extraction_mapping = self._get_extraction_mapping()
+        logging.info("Extracting: {}".format(ujson.dumps(extraction_mapping, indent=2)))
+
+        # columnar and case store sinks take the records rather than formatted lines
+        record_sink = hasattr(output_sink, "write_record")
+        if self.sort_field is not None:
+            if self.workers > 1:
+                logging.warning("Workers are not used when sorting, processing users in sequence.")
+            self._process_sorted(extraction_mapping, output_sink, record_sink)
+            return
+        elif self.workers > 1 and not record_sink:
+            self._process_parallel(extraction_mapping, output_sink)
+            return
+        elif self.workers > 1 and isinstance(output_sink, ShardedSink):
+            logging.warning("Workers are not used with --output_dir, processing users in sequence.")
+        elif self.workers > 1:
+            logging.warning("Workers are only supported with jsonl output, processing users in sequence.")
+
+        self._process_pipeline(extraction_mapping, output_sink, record_sink)
+
+    def _process_sorted(self, extraction_mapping, output_sink, record_sink):
+        """Write the activities of all extraction sets merged in sort_field order.
+
+        Params:
+            extraction_mapping (dict): username -> cdp_location -> file locations
+            output_sink (OutputSink): Where to write the output.
+            record_sink (bool): True = The sink takes records instead of output lines.
+        """
+        template = None
+        if self.output_template:
+            template = compile_template(self.output_template)
+
+        record_timers = {}
+        for _, record, extra in self.iter_sorted_records(extraction_mapping):
+            record_timer = None
+            if self.stats is not None:
+                stats_source = self._get_stats_source(extra["_user"], extra["_cpd_location"])
+                record_timer = record_timers.get(stats_source)
+                if record_timer is None:
+                    record_timer = record_timers[stats_source] = RecordTimer(
+                        self.stats, stats_source
+                    )
+
+            if record_sink and record_timer is not None:
+                record_timer.write_record(output_sink, record, extra)
+            elif record_sink:
+                output_sink.write_record(record, extra)
+            elif record_timer is not None:
+                output_sink.write(record_timer.format_record(record, extra, template))
+            else:
+                output_sink.write(format_record(record, extra, template))
+
+    def iter_sorted_records(self, extraction_mapping=None):
+        """Extract the databases of all users, then iterate their activities merged in
+        sort_field order. Each database is read in order by SQLite, so only the next
+        record of each database is held while merging.
+
+        Params:
+            extraction_mapping (dict): username -> cdp_location -> file locations.
+                None = find the databases on the volume.
+        Yields:
+            (tuple): (sort key, record, extra fields)
+        """
+        if self.sort_field is None or self.dump_db:
+            raise Exception("Sorting needs a sort_field and cannot be used with dump_db.")
+        if extraction_mapping is None:
+            extraction_mapping = self._get_extraction_mapping()
+
+        fields = self.fields
+        if self.output_template and fields is None:
+            fields = compile_template(self.output_template).field_names
+
+        # with cleanup, the extracted files are removed once the merge is done
+        with self.temp_manager:
+            streams = []
+            for username in extraction_mapping.keys():
+                for cdp_location in extraction_mapping[username]:
+                    extraction_set = self.temp_manager.get_extraction_set(
+                        username, cdp_location
+                    )
+                    self._extract_files(
+                        extraction_set, extraction_mapping[username][cdp_location]
+                    )
+
+                    records = self._iter_records(extraction_set, username, cdp_location, fields)
+                    if self.stats is not None:
+                        records = self.stats.iter_timed(
+                            records, self._get_stats_source(username, cdp_location), "sqlite"
+                        )
+                    keyed_records = iter_keyed_records(records)
+                    if self.wal_history:
+                        # the versions of each commit are in order, all versions together are not
+                        keyed_records = iter_external_sorted(
+                            keyed_records, self.temp_manager.temp_location
+                        )
+                    streams.append(keyed_records)
+
+            for keyed_record in merge_sorted(streams):
+                yield keyed_record
+
+    def iter_summary(self, summary, extraction_mapping=None):
+        """Extract the databases of all users, then iterate the rows of a Summary
+        aggregated by SQLite in each database and merged across the users.
+
+        Params:
+            summary (Summary): The summary to run.
+            extraction_mapping (dict): username -> cdp_location -> file locations.
+                None = find the databases on the volume.
+        Yields:
+            (tuple): (merge key, row), in key order.
+        """
+        if extraction_mapping is None:
+            extraction_mapping = self._get_extraction_mapping()
+
+        with self.temp_manager:
+            streams = []
+            for username in extraction_mapping.keys():
+                for cdp_location in extraction_mapping[username]:
+                    extraction_set = self.temp_manager.get_extraction_set(
+                        username, cdp_location
+                    )
+                    self._extract_files(
+                        extraction_set, extraction_mapping[username][cdp_location]
+                    )
+                    streams.append(self._iter_summary_rows(
+                        summary, extraction_set, username, cdp_location
+                    ))
+
+            for keyed_row in iter_merged_rows(summary, streams):
+                yield keyed_row
+
+    def _iter_summary_rows(self, summary, extraction_set, username, cdp_location):
+        extra = dict({
+            "_user": username,
+            "_cpd_location": cdp_location
+        }, **self.extra)
+        with self._open_activities_db(extraction_set, username, cdp_location) as activities_db:
+            rows = activities_db.iter_summary(summary, self.activity_filter)
+            if self.stats is not None:
+                rows = self.stats.iter_timed(
+                    rows, self._get_stats_source(username, cdp_location), "sqlite"
+                )
+            for keyed_row in iter_keyed_rows(summary, rows, extra):
+                yield keyed_row
+
+    def _process_pipeline(self, extraction_mapping, output_sink, record_sink):
+        """Extract, decode and write the extraction sets in three overlapping stages.
+
+        An extraction thread reads the files of the next set while the current one
+        is decoded, and a writer thread writes batches of output while the next
+        batch is decoded. The queues between the stages are bounded, so a fast stage
+        waits for a slow one instead of buffering ahead.
+
+        Params:
+            extraction_mapping (dict): username -> cdp_location -> file locations
+            output_sink (OutputSink): Where to write the output.
+            record_sink (bool): True = The sink takes records instead of output lines.
+        """
+        extracted_sets = queue.Queue(maxsize=PIPELINE_EXTRACT_AHEAD)
+        output_batches = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        stopped = threading.Event()
+        errors = []
+
+        extractor = threading.Thread(
+            target=self._extract_stage, name="extract",
+            args=(extraction_mapping, extracted_sets, stopped, errors)
+        )
+        writer = threading.Thread(
+            target=self._write_stage, name="write",
+            args=(output_sink, record_sink, output_batches, errors)
+        )
+        extractor.daemon = True
+        writer.daemon = True
+        extractor.start()
+        writer.start()
+
+        try:
+            while True:
+                extracted_set = extracted_sets.get()
+                if extracted_set is None:
+                    break
+
+                extraction_set, username, cdp_location = extracted_set
+                stats_source = self._get_stats_source(username, cdp_location)
+                if record_sink:
+                    records = self._iter_records(
+                        extraction_set, username, cdp_location, self.fields
+                    )
+                    if self.stats is not None:
+                        records = self.stats.iter_timed(records, stats_source, "sqlite")
+                    outputs = (
+                        (record, dict(extra, _user=username, _cpd_location=cdp_location))
+                        for record, extra in records
+                    )
+                else:
+                    outputs = self._iter_output(extraction_set, username, cdp_location)
+
+                batch = []
+                for output in outputs:
+                    batch.append(output)
+                    if len(batch) >= PIPELINE_BATCH_SIZE:
+                        self._put_stage(output_batches, (extracted_set, batch), writer, errors)
+                        batch = []
+                if batch:
+                    self._put_stage(output_batches, (extracted_set, batch), writer, errors)
+                if record_sink:
+                    # no batch, the set is done
+                    self._put_stage(output_batches, (extracted_set, None), writer, errors)
+        finally:
+            stopped.set()
+            # let a waiting extraction thread see that the pipeline stopped
+            while extractor.is_alive():
+                try:
+                    extracted_sets.get(timeout=PIPELINE_POLL_SECONDS)
+                except queue.Empty:
+                    pass
+            try:
+                self._put_stage(output_batches, None, writer, errors)
+            except BaseException:
+                # the writer already stopped with an error
+                pass
+            writer.join()
+
+        if errors:
+            raise errors[0]
+
+    def _extract_stage(self, extraction_mapping, extracted_sets, stopped, errors):
+        """Extraction thread, extracts the sets in order and queues them for decoding."""
+        try:
+            for username in extraction_mapping.keys():
+                for cdp_location in extraction_mapping[username]:
+                    if stopped.is_set():
+                        return
+
+                    extraction_set = self.temp_manager.get_extraction_set(
+                        username, cdp_location
+                    )
+                    self._extract_files(
+                        extraction_set, extraction_mapping[username][cdp_location]
+                    )
+                    self._put_stage(
+                        extracted_sets, (extraction_set, username, cdp_location), None, errors,
+                        stopped
+                    )
+        except Exception as error:
+            errors.append(error)
+        finally:
+            self._put_stage(extracted_sets, None, None, errors, stopped)
+
+    def _write_stage(self, output_sink, record_sink, output_batches, errors):
+        """Writer thread, writes the output batches until it gets None."""
+        try:
+            while True:
+                item = output_batches.get()
+                if item is None:
+                    return
+
+                (extraction_set, username, cdp_location), batch = item
+                stats_source = self._get_stats_source(username, cdp_location)
+                if batch is None:
+                    if hasattr(output_sink, "finish_source"):
+                        output_sink.finish_source(
+                            self.extra.get("_source"), username, cdp_location
+                        )
+                    continue
+
+                if record_sink:
+                    write_record = output_sink.write_record
+                    if self.stats is not None:
+                        write_record = functools.partial(
+                            RecordTimer(self.stats, stats_source).write_record, output_sink
+                        )
+                    for record, extra in batch:
+                        write_record(record, extra)
+                    continue
+
+                if self.stats is not None:
+                    sink_position = self.stats.get_sink_position(output_sink)
+                for output in batch:
+                    output_sink.write(output)
+                if self.stats is not None:
+                    self.stats.add_sink(stats_source, "write", output_sink, sink_position)
+        except BaseException as error:
+            # BrokenPipeError included, the main thread raises it to the sink
+            errors.append(error)
+
+    @staticmethod
+    def _put_stage(stage_queue, item, consumer, errors, stopped=None):
+        """Put an item on a bounded queue, waiting for space unless the consumer thread
+        died or the pipeline stopped."""
+        while True:
+            try:
+                stage_queue.put(item, timeout=PIPELINE_POLL_SECONDS)
+                return
+            except queue.Full:
+                if stopped is not None and stopped.is_set():
+                    return
+                if consumer is not None and not consumer.is_alive():
+                    raise errors[0] if errors else Exception("The writer thread stopped.")
+
+    def _process_parallel(self, extraction_mapping, output_sink):
+        """Hand each extraction set to a worker process and write their output.
+
+        Params:
+            extraction_mapping (dict): username -> cdp_location -> file locations
+            output_sink (OutputSink): Where to write the output.
+        """
+        if not self.source:
+            raise Exception("A volume source is needed to process with workers.")
+
+        processor_options = {
+            "temp_location": self.temp_manager.temp_location,
+            "output_template": self.output_template,
+            "dump_db": self.dump_db,
+            "dump_threads": self.dump_threads,
+            "fields": self.fields,
+            "activity_filter": self.activity_filter,
+            "enrich": self.enrich,
+            "enrich_operations": self.enrich_operations,
+            "wal_index": self.wal_index,
+            "wal_history": self.wal_history,
+            "extra": self.extra,
+            "stats": Stats() if self.stats is not None else None,
+            "state": self.state,
+            "in_memory": self.in_memory,
+            "memory_limit": self.memory_limit
+        }
+        jobs = []
+        for username in extraction_mapping.keys():
+            for cdp_location in extraction_mapping[username]:
+                jobs.append((
+                    username, cdp_location, extraction_mapping[username][cdp_location]
+                ))
+
+        pool = multiprocessing.Pool(
+            self.workers, initializer=_init_extraction_worker,
+            initargs=(self.source, processor_options)
+        )
+        with pool:
+            if self.ordered:
+                results = pool.imap(_process_extraction_set, jobs)
+            else:
+                results = pool.imap_unordered(_process_extraction_set, jobs)
+
+            for output_location, state_key, state_entry, stats in results:
+                if stats is not None:
+                    sink_position = self.stats.get_sink_position(output_sink)
+                try:
+                    output_sink.copy_file(output_location)
+                finally:
+                    os.remove(output_location)
+                if stats is not None:
+                    self.stats.merge(stats)
+                    # copying the worker output is done for the whole volume
+                    self.stats.add_sink(
+                        self.description, "copy", output_sink, sink_position
+                    )
+                if state_entry:
+                    self.state.entries[state_key] = state_entry
+
+    def _get_extraction_mapping(self):
+        """Get the files to extract for each user and cdp location.
+
+        Returns:
+            (dict): username -> cdp_location -> file locations, (path, meta address) tuples.
+                The meta address is None for files that are opened by path.
+        """
+        if self.discover:
+            return self._discover_extraction_mapping()
 
-    def process(self):
-        """Extract and process files from a logical volume."""
         user_name_list = self._username_list()
+        if self.users:
+            users = [username.lower() for username in self.users]
+            user_name_list = [
+                username for username in user_name_list
+                if username.lower() in users
+            ]
+
         extraction_mapping = {}
         for username in user_name_list:
             base_location = "/Users/{username}/AppData/Local/ConnectedDevicesPlatform/".format(
@@ -139,65 +714,307 @@ class VolumeProcessor(object):
                 activities_wal = db_location + "ActivitiesCache.db-wal"
                 activities_shm = db_location + "ActivitiesCache.db-shm"
 
-                extraction_mapping[username][info["stableUserId"]].append(activities_db)
-                extraction_mapping[username][info["stableUserId"]].append(activities_wal)
-                extraction_mapping[username][info["stableUserId"]].append(activities_shm)
+                extraction_mapping[username][info["stableUserId"]].append((activities_db, None))
+                extraction_mapping[username][info["stableUserId"]].append((activities_wal, None))
+                extraction_mapping[username][info["stableUserId"]].append((activities_shm, None))
 
-        logging.info("Extracting: {}".format(ujson.dumps(extraction_mapping, indent=2)))
-        for username in extraction_mapping.keys():
-            for cdp_location in extraction_mapping[username]:
-                extraction_set = self.temp_manager.get_extraction_set(
-                    username, cdp_location
+        return extraction_mapping
+
+    def _extract_files(self, extraction_set, file_locations):
+        extract_counter = None
+        if self.stats is not None:
+            extract_counter = self.stats.get_counter(self._get_stats_source(
+                extraction_set.set_metadata.username, extraction_set.set_metadata.cdp_location
+            ), "extract")
+
+        tsk_files = []
+        for file_location, meta_address in file_locations:
+            start = time.perf_counter()
+            try:
+                if meta_address is None:
+                    tsk_file = self.tsk_fs.open(file_location)
+                else:
+                    tsk_file = self.tsk_fs.open_meta(inode=meta_address)
+            except Exception as error:
+                logging.error("Could not extract file: {} [error: {}]".format(
+                    file_location, error
+                ))
+                continue
+            tsk_files.append((file_location, tsk_file, time.perf_counter() - start))
+
+        if extraction_set.in_memory and self.memory_limit is not None:
+            set_size = sum(tsk_file.info.meta.size for _, tsk_file, _ in tsk_files)
+            if set_size > self.memory_limit:
+                logging.warning("{} bytes of {} is over the memory limit, extracting to {}".format(
+                    set_size, self._get_stats_source(
+                        extraction_set.set_metadata.username,
+                        extraction_set.set_metadata.cdp_location
+                    ), extraction_set.set_extract_location
+                ))
+                extraction_set.in_memory = False
+                extraction_set.make_extract_location()
+
+        for file_location, tsk_file, open_seconds in tsk_files:
+            start = time.perf_counter()
+            extraction_set.extract_file(
+                tsk_file, file_location
+            )
+            if extract_counter is not None:
+                extract_counter.add(
+                    open_seconds + time.perf_counter() - start, 1, tsk_file.info.meta.size
                 )
-                for file_location in extraction_mapping[username][cdp_location]:
-                    tsk_file = None
-                    try:
-                        tsk_file = self.tsk_fs.open(file_location)
-                    except Exception as error:
-                        logging.error("Could not extract file: {} [error: {}]".format(
-                            file_location, error
-                        ))
-                        continue
-
-                    extraction_set.extract_file(
-                        tsk_file, file_location
-                    )
 
-                db_location = extraction_set.get_activities_location()
-                activities_db = ActivitiesDb(
-                    db_location
+    def _get_image(self, extraction_set, username, cdp_location):
+        """Get the database image of a set read into memory, with its WAL applied. The
+        file contents of the set are released, only the image is kept."""
+        db_data = extraction_set.get_activities_data()
+        wal_data = extraction_set.get_wal_data()
+        extraction_set.release()
+        if db_data is None:
+            raise Exception("No {} was read for {}".format(
+                ACTIVITIES_CACHE_NAME, self._get_stats_source(username, cdp_location)
+            ))
+
+        start = time.perf_counter()
+        image = get_database_image(db_data, wal_data)
+        seconds = time.perf_counter() - start
+
+        # SQLite keeps its own copy of the image while it is open
+        memory_size = len(image) * 2
+        logging.info("In memory: {} [database: {}, WAL: {}, image: {} bytes]".format(
+            self._get_stats_source(username, cdp_location), len(db_data),
+            len(wal_data or b""), len(image)
+        ))
+        if self.stats is not None:
+            self.stats.add(
+                self._get_stats_source(username, cdp_location), "image", seconds, 1, memory_size
+            )
+        return image
+
+    def _iter_output(self, extraction_set, username, cdp_location):
+        """Iterate the formatted output lines of an extracted set."""
+        template = None
+        fields = self.fields
+        if self.output_template:
+            template = compile_template(self.output_template)
+            if fields is None:
+                # only read and decode the fields the template prints
+                fields = template.field_names
+
+        records = self._iter_records(
+            extraction_set, username, cdp_location, fields
+        )
+        output_format = format_record
+        if self.stats is not None:
+            stats_source = self._get_stats_source(username, cdp_location)
+            records = self.stats.iter_timed(records, stats_source, "sqlite")
+            output_format = RecordTimer(self.stats, stats_source).format_record
+
+        for record, extra in records:
+            yield output_format(record, extra, template)
+
+    def _iter_records(self, extraction_set, username, cdp_location, fields):
+        """Iterate the records of an extracted set and the extra fields to output with them.
+
+        Yields:
+            (tuple): (record, extra fields)
+        """
+        db_location = extraction_set.get_activities_location()
+        wal_location = extraction_set.get_wal_location()
+        if self.wal_history and not self.dump_db:
+            db_data = None
+            wal_data = None
+            if extraction_set.in_memory:
+                db_data = extraction_set.get_activities_data()
+                wal_data = extraction_set.get_wal_data()
+                extraction_set.release()
+
+            versions = iter_activity_versions(
+                db_location, wal_location, fields, self.activity_filter,
+                self.enrich, self.enrich_operations, self.sort_field, db_data, wal_data
+            )
+            for commit, record in versions:
+                yield record, dict({
+                    "_user": username,
+                    "_cpd_location": cdp_location,
+                    "_wal_commit": commit
+                }, **self.extra)
+            return
+
+        with self._open_activities_db(extraction_set, username, cdp_location) as activities_db:
+            if self.dump_db:
+                for record in activities_db.iter_records(fields, self.dump_threads):
+                    yield record, dict({"_table": record._table}, **self.extra)
+                return
+
+            state_key = None
+            if self.state is not None:
+                state_key = self._get_state_key(extraction_set, username, cdp_location)
+                activity_sequence = activities_db.get_activity_sequence()
+                max_etag = activities_db.get_max_etag()
+                records = activities_db.iter_activities(
+                    self.state.get_sequence(state_key, activity_sequence), fields,
+                    self.activity_filter, self.enrich, self.enrich_operations, self.sort_field
+                )
+            else:
+                records = activities_db.iter_activities(
+                    0, fields, self.activity_filter, self.enrich, self.enrich_operations,
+                    self.sort_field
                 )
-                formatter = None
-                if self.output_template:
-                    formatter = CustomStringFormatter()
-
-                if self.dump_db:
-                    for record in activities_db.iter_records():
-                        formatted_record = record.as_ordered_dict()
-                        formatted_record.insert(0, ("_table", record._table))
-                        if formatter:
-                            output = formatter.format(
-                                self.output_template, **formatted_record
-                            )
-                            print(output)
-                        else:
-                            print(ujson.dumps(
-                                formatted_record
-                            ))
+
+            extra = dict({
+                "_user": username,
+                "_cpd_location": cdp_location
+            }, **self.extra)
+            for record in records:
+                yield record, extra
+
+            if state_key is not None:
+                self.state.update(state_key, max_etag, activity_sequence)
+
+    def _open_activities_db(self, extraction_set, username, cdp_location):
+        """Open the database of an extracted set, or the image of a set read into memory."""
+        db_options = {}
+        wal_location = extraction_set.get_wal_location()
+        if extraction_set.in_memory:
+            db_options["image"] = self._get_image(extraction_set, username, cdp_location)
+        elif self.wal_index and wal_location:
+            db_options["wal"] = wal_location
+
+        return ActivitiesDb(extraction_set.get_activities_location(), **db_options)
+
+    def _get_state_key(self, extraction_set, username, cdp_location):
+        """Get the state key of an extracted database, the volume, user, cdp location
+        and the metadata address of the database file."""
+        return self.state.get_key(
+            self.description, username, cdp_location,
+            extraction_set.meta_addresses.get("ActivitiesCache.db")
+        )
+
+    def _iter_directory_files(self):
+        """Walk the directory metadata of the volume once, from the root directory.
+
+        Every directory is opened by its meta address and visited once, so hard links
+        and junctions do not loop, and deleted names are skipped.
+
+        Yields:
+            (tuple): (path, meta address) of each allocated file that is not a directory.
+        """
+        visited = set()
+        stack = [(self.tsk_fs.info.root_inum, "")]
+        while stack:
+            meta_address, path = stack.pop()
+            if meta_address in visited:
+                continue
+            visited.add(meta_address)
+
+            try:
+                directory = self.tsk_fs.open_dir(inode=meta_address)
+            except Exception as error:
+                logging.debug("Could not open directory: {} [error: {}]".format(path or "/", error))
+                continue
+
+            for tsk_file in directory:
+                name_info = tsk_file.info.name
+                if name_info is None or name_info.flags & pytsk3.TSK_FS_NAME_FLAG_UNALLOC:
+                    continue
+
+                filename = name_info.name.decode('utf-8', 'replace')
+                if filename in [u".", u".."] or filename == u"$OrphanFiles":
+                    continue
+
+                file_path = path + "/" + filename
+                if name_info.type == pytsk3.TSK_FS_NAME_TYPE_DIR:
+                    stack.append((name_info.meta_addr, file_path))
                 else:
-                    for record in activities_db.iter_activities(0):
-                        formatted_record = record.as_ordered_dict()
-                        formatted_record["_user"] = username
-                        formatted_record["_cpd_location"] = cdp_location
-                        if formatter:
-                            output = formatter.format(
-                                self.output_template, **formatted_record
-                            )
-                            print(output)
-                        else:
-                            print(ujson.dumps(
-                                formatted_record
-                            ))
+                    yield file_path, name_info.meta_addr
+
+    def _discover_extraction_mapping(self):
+        """Get the files to extract by walking the volume once. Databases are found
+        wherever they are, also for users without a CDPGlobalSettings.cdp or with a
+        profile outside of /Users.
+
+        Returns:
+            (dict): username -> cdp_location -> (path, meta address) tuples.
+        """
+        activities_cache_name = ACTIVITIES_CACHE_NAME.lower()
+        cdp_settings_name = CDP_SETTINGS_NAME.lower()
+
+        database_sets = {}
+        settings_files = []
+        for file_path, meta_address in self._iter_directory_files():
+            directory, filename = file_path.rsplit("/", 1)
+            filename = filename.lower()
+            if filename.startswith(activities_cache_name):
+                # name the extracted files the way the database expects them
+                file_path = "{}/{}{}".format(
+                    directory, ACTIVITIES_CACHE_NAME, filename[len(activities_cache_name):]
+                )
+                database_sets.setdefault(directory, []).append((file_path, meta_address))
+            elif filename == cdp_settings_name:
+                settings_files.append((directory, meta_address))
+
+        if self.users:
+            users = [username.lower() for username in self.users]
+
+        extraction_mapping = {}
+        for directory in sorted(database_sets.keys()):
+            username, cdp_location = self._get_set_names(directory)
+            if self.users and username.lower() not in users:
+                continue
+
+            cdp_locations = extraction_mapping.setdefault(username, {})
+            if cdp_location in cdp_locations:
+                # the same user and cdp location in another folder, such as Windows.old
+                cdp_location = "{}-{}".format(cdp_location, len(cdp_locations))
+            cdp_locations[cdp_location] = sorted(database_sets[directory])
+
+        for directory, meta_address in settings_files:
+            settings = self._get_cpd_global_settings_by_address(directory, meta_address)
+            if not settings:
+                continue
+
+            for info in settings.get("ActivityStoreInfo", []):
+                db_directory = "{}/{}".format(directory, info["stableUserId"])
+                if db_directory not in database_sets:
+                    logging.warning("{} lists a database that was not found: {}".format(
+                        directory + "/" + CDP_SETTINGS_NAME, db_directory
+                    ))
+
+        return extraction_mapping
+
+    @staticmethod
+    def _get_set_names(directory):
+        """Get the username and cdp location of a database folder such as
+        /Users/<username>/AppData/Local/ConnectedDevicesPlatform/<cdp_location>."""
+        parts = directory.split("/")
+        cdp_location = parts[-1]
+
+        lower_parts = [part.lower() for part in parts]
+        if "appdata" in lower_parts:
+            username = parts[lower_parts.index("appdata") - 1]
+        elif len(parts) > 2:
+            username = parts[-2]
+        else:
+            username = u""
+        return username, cdp_location
+
+    def _get_cpd_global_settings_by_address(self, directory, meta_address):
+        try:
+            tsk_file = self.tsk_fs.open_meta(inode=meta_address)
+            data = tsk_file.read_random(
+                0, tsk_file.info.meta.size
+            )
+            return ujson.loads(
+                data.decode('utf-8-sig')
+            )
+        except Exception as error:
+            logging.warning("Could not read settings: {} [error: {}]".format(
+                directory + "/" + CDP_SETTINGS_NAME, error
+            ))
+
+    def _get_stats_source(self, username, cdp_location):
+        return "{}|{}|{}".format(self.description, username, cdp_location)
 
     def _get_cpd_global_settings(self, location):
         logging.debug("Attempting to get cpd settings from: {}".format(location))
@@ -0,0 +1,134 @@
+import os
+import sys
+import time
+import ujson
+import logging
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+
+def format_record(record, extra, template=None):
+    """Format a record as a template line, or as JSON without a template.
+
+    Params:
+        record (GenericRecord): The record.
+        extra (dict): Additional fields to output with the record.
+        template (CompiledTemplate): The output template. None = JSON.
+    """
+    formatted_record = record.as_ordered_dict()
+    formatted_record.update(extra)
+    if template:
+        return template.render(formatted_record)
+    return ujson.dumps(formatted_record)
+
+
+def format_row(row, template=None):
+    """Format a dict, such as a summary row, as a template line or as JSON."""
+    if template:
+        return template.render(row)
+    return ujson.dumps(row)
+
+
+class OutputSink(object):
+    """Buffers output lines and writes them to stdout or a file in large chunks."""
+    def __init__(self, location=None, buffer_size=DEFAULT_BUFFER_SIZE):
+        """Create OutputSink
+
+        Params:
+            location (unicode): The output file. None = stdout.
+            buffer_size (int): The number of bytes to gather before writing.
+        """
+        self.location = location
+        self.buffer_size = buffer_size
+        self.broken_pipe = False
+        self.records_written = 0
+        self.bytes_written = 0
+        self.write_seconds = 0.0
+        self._buffer = bytearray()
+
+        if self.location:
+            self._fh = open(self.location, "wb")
+        else:
+            self._fh = sys.stdout.buffer
+
+    def write(self, line):
+        """Write a line of output.
+
+        Params:
+            line (unicode): The line without the line ending.
+        """
+        self._buffer += line.encode("utf-8")
+        self._buffer += b"\n"
+        self.records_written += 1
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def write_raw(self, data):
+        """Write already encoded output.
+
+        Params:
+            data (bytes): The encoded lines, including line endings.
+        """
+        self._buffer += data
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def copy_file(self, location):
+        """Write the contents of an already encoded output file.
+
+        Params:
+            location (unicode): The file to copy.
+        """
+        with open(location, "rb") as fh:
+            while True:
+                data = fh.read(self.buffer_size)
+                if not data:
+                    break
+                self.write_raw(data)
+
+    def flush(self):
+        if not self._buffer:
+            return
+
+        start = time.perf_counter()
+        try:
+            self._fh.write(self._buffer)
+            self._fh.flush()
+            self.bytes_written += len(self._buffer)
+        finally:
+            self._buffer.clear()
+            self.write_seconds += time.perf_counter() - start
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.location:
+                self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is BrokenPipeError:
+            self._handle_broken_pipe()
+            return True
+
+        try:
+            self.close()
+        except BrokenPipeError:
+            self._handle_broken_pipe()
+            return True
+
+    def _handle_broken_pipe(self):
+        """The reader went away, stop writing and exit without a traceback."""
+        logging.debug("Output pipe was closed by the reader.")
+        self.broken_pipe = True
+        self._buffer.clear()
+        if not self.location:
+            # Python flushes stdout at shutdown, point it at devnull so that
+            # does not raise again.
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+        else:
+            self._fh.close()
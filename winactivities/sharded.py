@@ -0,0 +1,262 @@
+import os
+import re
+import gzip
+import ujson
+import logging
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from winactivities.output import format_record
+
+COMPRESSIONS = ["gzip", "zstd", "none"]
+COMPRESSION_EXTENSIONS = {
+    "gzip": ".gz",
+    "zstd": ".zst",
+    "none": ""
+}
+DEFAULT_SHARD_SIZE = 256 * 1024 * 1024
+# uncompressed bytes per compressed gzip member or zstd frame
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+DEFAULT_COMPRESSION_THREADS = 4
+MANIFEST_NAME = "manifest.json"
+
+
+def get_compressor(compression, level=None):
+    """Get the function that compresses a chunk of output. Compressed chunks are complete
+    gzip members or zstd frames, which can be concatenated into one file.
+
+    Params:
+        compression (unicode): gzip, zstd or none
+        level (int): The compression level. None = the default of the compression.
+    Returns:
+        (function): bytes -> compressed bytes, None for none.
+    """
+    if compression == "gzip":
+        compress_level = 6 if level is None else level
+
+        def compress(data):
+            return gzip.compress(data, compresslevel=compress_level, mtime=0)
+        return compress
+    elif compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("zstandard is required for zstd compression.")
+
+        compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+        return compressor.compress
+    elif compression == "none":
+        return None
+
+    raise Exception("{} is not a valid compression.".format(compression))
+
+
+def _get_name_part(value):
+    """Get a value, such as a source path, as part of a file name."""
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", value).strip("_")
+
+
+class _Shard(object):
+    """The output of one (source, user, cdp location, table), written to numbered files."""
+    def __init__(self, directory, key, extension):
+        """Create _Shard
+
+        Params:
+            directory (unicode): The output directory.
+            key (tuple): (source, user, cdp location, table), None parts are left out of the name.
+            extension (unicode): The file extension, such as .jsonl.gz
+        """
+        self.directory = directory
+        self.source, self.user, self.cdp_location, self.table = key
+        self.extension = extension
+        self.base_name = "-".join(
+            _get_name_part(part) for part in key if part is not None
+        )
+
+        self.number = 0
+        self.lines = []
+        self.buffered_size = 0
+        self.pending = collections.deque()
+        self.location = None
+        self._fh = None
+        self.rows = 0
+        self.size = 0
+        self.compressed_size = 0
+
+    def open(self):
+        self.location = os.path.join(self.directory, "{}.{:04d}{}".format(
+            self.base_name, self.number, self.extension
+        ))
+        self._fh = open(self.location, "wb")
+        self.rows = 0
+        self.size = 0
+        self.compressed_size = 0
+
+    @property
+    def is_open(self):
+        return self._fh is not None
+
+    def write(self, data):
+        self._fh.write(data)
+        self.compressed_size += len(data)
+
+    def close(self):
+        """Close the current file.
+
+        Returns:
+            (dict): The manifest entry of the file.
+        """
+        self._fh.close()
+        self._fh = None
+        self.number += 1
+        return {
+            "file": os.path.basename(self.location),
+            "source": self.source,
+            "user": self.user,
+            "cdp_location": self.cdp_location,
+            "table": self.table,
+            "rows": self.rows,
+            "bytes": self.size,
+            "compressed_bytes": self.compressed_size
+        }
+
+
+class ShardedSink(object):
+    """Writes the output lines of each (source, user, cdp location, table) to its own
+    files in a directory, compressed on a thread pool while parsing goes on.
+
+    Each file is rotated when its uncompressed output reaches shard_size. The
+    output is compressed in chunks, and the chunks are written in order, so a file
+    is a multi-member gzip or multi-frame zstd stream that standard tools read as
+    one. A manifest.json with the rows and bytes of every file is written on close.
+    """
+    def __init__(self, location, template=None, compression="gzip",
+                 shard_size=DEFAULT_SHARD_SIZE, threads=DEFAULT_COMPRESSION_THREADS,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        """Create ShardedSink
+
+        Params:
+            location (unicode): The output directory, created if it does not exist.
+            template (CompiledTemplate): The output template. None = JSON.
+            compression (unicode): gzip, zstd or none
+            shard_size (int): The uncompressed bytes to write to a file before the next one.
+            threads (int): The number of threads that compress chunks.
+            chunk_size (int): The uncompressed bytes to compress at a time.
+        """
+        self.location = location
+        self.template = template
+        self.compression = compression
+        self.shard_size = shard_size
+        self.chunk_size = min(chunk_size, shard_size)
+        self.threads = threads
+        self.broken_pipe = False
+        self.records_written = 0
+        self.manifest = []
+
+        self._compress = get_compressor(compression)
+        # template lines are not JSON
+        self._extension = ".jsonl" if template is None else ".txt"
+        self._extension += COMPRESSION_EXTENSIONS[compression]
+        self._shards = {}
+        self._pool = None
+        if self._compress is not None:
+            self._pool = ThreadPoolExecutor(max_workers=threads)
+
+        if not os.path.isdir(self.location):
+            os.makedirs(self.location, exist_ok=True)
+
+    def write_record(self, record, extra=None):
+        """Write a record.
+
+        Params:
+            record (GenericRecord): The record.
+            extra (dict): Additional fields to output, _source, _user, _cpd_location and
+                _table select the shard.
+        """
+        extra = extra or {}
+        key = (
+            extra.get("_source"), extra.get("_user"), extra.get("_cpd_location"),
+            record._table or "Activity"
+        )
+        shard = self._shards.get(key)
+        if shard is None:
+            shard = self._shards[key] = _Shard(self.location, key, self._extension)
+        if not shard.is_open:
+            # the next file is only opened once there is a record for it
+            shard.open()
+
+        line = format_record(record, extra, self.template)
+        shard.lines.append(line)
+        shard.buffered_size += len(line) + 1
+        shard.rows += 1
+        self.records_written += 1
+        if shard.buffered_size >= self.chunk_size:
+            self._write_chunk(shard)
+            if shard.size >= self.shard_size:
+                self._finish(shard)
+
+    def _write_chunk(self, shard):
+        if not shard.lines:
+            return
+
+        data = ("\n".join(shard.lines) + "\n").encode("utf-8")
+        shard.lines = []
+        shard.buffered_size = 0
+        shard.size += len(data)
+        if self._pool is None:
+            shard.write(data)
+            return
+
+        shard.pending.append(self._pool.submit(self._compress, data))
+        # write the chunks that are done, and wait when a shard is too far ahead
+        while shard.pending and (shard.pending[0].done() or len(shard.pending) > self.threads):
+            shard.write(shard.pending.popleft().result())
+
+    def _finish(self, shard):
+        self._write_chunk(shard)
+        while shard.pending:
+            shard.write(shard.pending.popleft().result())
+        self.manifest.append(shard.close())
+
+    def finish_source(self, source, user=None, cdp_location=None):
+        """Finish and close the open files of a source that is done, so that a batch
+        of many sources does not keep a file and its buffered lines open for each of them.
+        A shard that gets records again later continues in its next numbered file.
+
+        Params:
+            source (unicode): The _source of the records, None = a run of one source.
+            user (unicode): Only finish the files of this user. None = all users.
+            cdp_location (unicode): Only finish the files of this cdp location. None = all.
+        """
+        for shard in self._shards.values():
+            if not shard.is_open or shard.source != source:
+                continue
+            if user is not None and shard.user != user:
+                continue
+            if cdp_location is not None and shard.cdp_location != cdp_location:
+                continue
+            self._finish(shard)
+
+    def close(self):
+        for shard in self._shards.values():
+            if shard.is_open:
+                self._finish(shard)
+        self._shards = {}
+        if self._pool is not None:
+            self._pool.shutdown()
+
+        manifest_location = os.path.join(self.location, MANIFEST_NAME)
+        with open(manifest_location, "w") as fh:
+            fh.write(ujson.dumps({
+                "compression": self.compression,
+                "records": self.records_written,
+                "shards": self.manifest
+            }, indent=2))
+        logging.info("Wrote {} records to {} files in {}".format(
+            self.records_written, len(self.manifest), self.location
+        ))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,79 @@
+import os
+import ujson
+import logging
+
+
+class StateFile(object):
+    """The highest ETag collected from each database, kept between runs."""
+    def __init__(self, location):
+        """Create StateFile
+
+        Params:
+            location (unicode): The state file, it is created on save if it does not exist.
+        """
+        self.location = location
+        self.entries = {}
+        self.updated_keys = set()
+
+        if os.path.isfile(self.location):
+            with open(self.location, "r", encoding="utf-8") as fh:
+                self.entries = ujson.load(fh)
+
+    @staticmethod
+    def get_key(*parts):
+        """Get the state key for a database from its identifying parts."""
+        return "|".join(str(part) for part in parts)
+
+    def get_sequence(self, key, activity_sequence=None):
+        """Get the ETag to continue collecting a database from.
+
+        Params:
+            key (unicode): The state key of the database.
+            activity_sequence (int): The current Activity ManualSequence value of the database.
+        Returns:
+            (int): Collect activities with an ETag above this value.
+        """
+        entry = self.entries.get(key)
+        if not entry:
+            return 0
+
+        if activity_sequence is not None and activity_sequence < entry["etag"]:
+            # the sequence went backwards, this is not the database we saw last time
+            logging.warning("Activity sequence for {} is lower than the saved ETag, collecting all records.".format(
+                key
+            ))
+            return 0
+
+        return entry["etag"]
+
+    def update(self, key, etag, activity_sequence=None):
+        """Record the highest ETag collected from a database.
+
+        Params:
+            key (unicode): The state key of the database.
+            etag (int): The highest ETag in the database, None = no activities.
+            activity_sequence (int): The Activity ManualSequence value of the database.
+        """
+        if etag is None:
+            return
+
+        self.entries[key] = {
+            "etag": etag,
+            "activity_sequence": activity_sequence
+        }
+        self.updated_keys.add(key)
+
+    def get_updated_entries(self):
+        """Get the entries updated by this process, a worker returns these and not its
+        copy of the other entries, which may be stale.
+
+        Returns:
+            (dict): state key -> entry
+        """
+        return dict((key, self.entries[key]) for key in self.updated_keys)
+
+    def save(self):
+        temp_location = self.location + ".tmp"
+        with open(temp_location, "w", encoding="utf-8") as fh:
+            ujson.dump(self.entries, fh, indent=2)
+        os.replace(temp_location, self.location)
@@ -0,0 +1,159 @@
+import sys
+import time
+import ujson
+
+STAGES = ["extract", "image", "sqlite", "decode", "format", "write", "copy"]
+
+
+class StageCounter(object):
+    """The wall time, rows and bytes of a processing stage."""
+    __slots__ = ("seconds", "rows", "size")
+
+    def __init__(self, seconds=0.0, rows=0, size=0):
+        self.seconds = seconds
+        self.rows = rows
+        self.size = size
+
+    def add(self, seconds=0.0, rows=0, size=0):
+        self.seconds += seconds
+        self.rows += rows
+        self.size += size
+
+
+class Stats(object):
+    """Stage counters per source (a database, or a database of a user on a volume).
+
+    Nothing is timed unless a Stats object is passed in, so runs without --stats
+    do not pay for the instrumentation.
+    """
+    def __init__(self):
+        self.sources = {}
+
+    def get_counter(self, source, stage):
+        stages = self.sources.get(source)
+        if stages is None:
+            stages = self.sources[source] = {}
+
+        counter = stages.get(stage)
+        if counter is None:
+            counter = stages[stage] = StageCounter()
+        return counter
+
+    def add(self, source, stage, seconds=0.0, rows=0, size=0):
+        self.get_counter(source, stage).add(seconds, rows, size)
+
+    def merge(self, other):
+        """Add the counters of another Stats, such as the one of a worker process."""
+        for source, stages in other.sources.items():
+            for stage, counter in stages.items():
+                self.add(source, stage, counter.seconds, counter.rows, counter.size)
+
+    def iter_timed(self, iterable, source, stage):
+        """Iterate an iterable, counting its items and the time spent producing them."""
+        counter = self.get_counter(source, stage)
+        clock = time.perf_counter
+        iterator = iter(iterable)
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                counter.seconds += clock() - start
+                return
+            counter.seconds += clock() - start
+            counter.rows += 1
+            yield item
+
+    def get_sink_position(self, output_sink):
+        """Get the counters of an OutputSink, to add what a source wrote with add_sink."""
+        return (
+            getattr(output_sink, "write_seconds", 0.0),
+            output_sink.records_written,
+            getattr(output_sink, "bytes_written", 0)
+        )
+
+    def add_sink(self, source, stage, output_sink, position):
+        """Add what an OutputSink wrote since get_sink_position. Sinks that do not
+        count their writes are timed with RecordTimer.write_record instead."""
+        if not hasattr(output_sink, "write_seconds"):
+            return
+
+        seconds, rows, size = self.get_sink_position(output_sink)
+        self.add(
+            source, stage, seconds - position[0], rows - position[1], size - position[2]
+        )
+
+    def write_report(self, fh=None):
+        """Write the stage counters of each source and the totals as a table."""
+        fh = fh or sys.stderr
+        fh.write("{:<48} {:<8} {:>10} {:>12} {:>14} {:>12}\n".format(
+            "source", "stage", "seconds", "rows", "bytes", "rows/s"
+        ))
+
+        totals = {}
+        for source, stages in self.sources.items():
+            for stage in STAGES:
+                counter = stages.get(stage)
+                if counter is None or not (counter.rows or counter.seconds):
+                    continue
+                self._write_row(fh, source, stage, counter)
+                totals.setdefault(stage, StageCounter()).add(
+                    counter.seconds, counter.rows, counter.size
+                )
+
+        if len(self.sources) > 1:
+            for stage in STAGES:
+                if stage in totals:
+                    self._write_row(fh, "total", stage, totals[stage])
+
+    @staticmethod
+    def _write_row(fh, source, stage, counter):
+        rows_per_second = 0
+        if counter.seconds:
+            rows_per_second = counter.rows / counter.seconds
+        if len(source) > 48:
+            source = "..." + source[-45:]
+        fh.write("{:<48} {:<8} {:>10.3f} {:>12} {:>14} {:>12.0f}\n".format(
+            source, stage, counter.seconds, counter.rows, counter.size, rows_per_second
+        ))
+
+
+class RecordTimer(object):
+    """Formats and writes the records of a source while timing each stage."""
+    def __init__(self, stats, source):
+        """Create RecordTimer
+
+        Params:
+            stats (Stats): The stats to add to.
+            source (unicode): The source of the records.
+        """
+        self._decode = stats.get_counter(source, "decode")
+        self._format = stats.get_counter(source, "format")
+        self._write = stats.get_counter(source, "write")
+
+    def format_record(self, record, extra, template=None):
+        """Same as output.format_record, timing the decoding and formatting apart."""
+        clock = time.perf_counter
+        start = clock()
+        formatted_record = record.as_ordered_dict()
+        decoded = clock()
+        formatted_record.update(extra)
+        if template:
+            output = template.render(formatted_record)
+        else:
+            output = ujson.dumps(formatted_record)
+        formatted = clock()
+
+        self._decode.seconds += decoded - start
+        self._decode.rows += 1
+        self._format.seconds += formatted - decoded
+        self._format.rows += 1
+        self._format.size += len(output)
+        return output
+
+    def write_record(self, output_sink, record, extra):
+        """Write a record to a ColumnarSink or CaseStoreSink, they decode and write it."""
+        start = time.perf_counter()
+        output_sink.write_record(record, extra)
+        self._write.seconds += time.perf_counter() - start
+        self._write.rows += 1
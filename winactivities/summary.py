@@ -0,0 +1,198 @@
+from winactivities.helpers import datetime_decode_1970_str
+from winactivities.timeline import merge_sorted
+
+# the first AppId entry, as in the AppId[0][application] template field
+APPLICATION_SQL = "CASE WHEN json_valid(AppId) THEN json_extract(AppId, '$[0].application') END"
+# Payload is a BLOB, newer SQLite versions read BLOBs as JSONB unless they are cast
+ACTIVE_DURATION_SQL = """CASE WHEN json_valid(CAST(Payload AS TEXT))
+    THEN json_extract(CAST(Payload AS TEXT), '$.activeDurationSeconds') END"""
+
+
+def _merge_sum(value, other_value):
+    if value is None or other_value is None:
+        return other_value if value is None else value
+    return value + other_value
+
+
+def _merge_min(value, other_value):
+    if value is None or other_value is None:
+        return other_value if value is None else value
+    return min(value, other_value)
+
+
+def _merge_max(value, other_value):
+    if value is None or other_value is None:
+        return other_value if value is None else value
+    return max(value, other_value)
+
+
+# NULL values are skipped, like the SQLite aggregates do
+MERGE_FUNCTIONS = {
+    "sum": _merge_sum,
+    "min": _merge_min,
+    "max": _merge_max
+}
+
+
+class Summary(object):
+    """A grouped query over the Activity table and how to merge its rows from
+    several databases."""
+    def __init__(self, name, description, group_columns, value_columns, time_columns=(),
+                 extra_keys=()):
+        """Create Summary
+
+        Params:
+            name (unicode): The --summary name.
+            description (unicode): What the summary counts.
+            group_columns (list): (column name, SQL expression) to group by.
+            value_columns (list): (column name, SQL aggregate, merge function name)
+            time_columns (tuple): Value columns of seconds since 1970 to output as UTC times.
+            extra_keys (tuple): Extra fields that keep rows apart when merging, such as _user.
+                Fields that a source does not have are left out.
+        """
+        self.name = name
+        self.description = description
+        self.group_columns = group_columns
+        self.value_columns = value_columns
+        self.time_columns = time_columns
+        self.extra_keys = extra_keys
+
+    def get_query(self, conditions):
+        """Get the query of the summary, ordered by its group columns.
+
+        Params:
+            conditions (list): The WHERE conditions.
+        Returns:
+            (unicode): The query.
+        """
+        select_columns = [
+            "{} AS {}".format(expression, name) for name, expression in self.group_columns
+        ] + [
+            "{} AS {}".format(aggregate, name) for name, aggregate, merge in self.value_columns
+        ]
+        group_names = ", ".join(name for name, expression in self.group_columns)
+        return """
+            SELECT {}
+            FROM Activity
+            WHERE {}
+            GROUP BY {}
+            ORDER BY {}
+        """.format(
+            ", ".join(select_columns),
+            " AND ".join(conditions or ["1"]),
+            group_names,
+            group_names
+        )
+
+    def get_row_key(self, row):
+        """Get the merge key of a row, in the order SQLite sorts the group columns."""
+        key_columns = [name for name in self.extra_keys if name in row]
+        key_columns.extend(name for name, expression in self.group_columns)
+        return tuple(_get_sqlite_order(row[name]) for name in key_columns)
+
+    def merge_rows(self, row, other_row):
+        """Add the values of a row with the same key into row."""
+        for name, aggregate, merge in self.value_columns:
+            row[name] = MERGE_FUNCTIONS[merge](row[name], other_row[name])
+
+    def format_row(self, row):
+        """Get a summary row for output, with its time columns as UTC times."""
+        for name in self.time_columns:
+            row[name] = datetime_decode_1970_str(row[name])
+        return row
+
+
+def _get_sqlite_order(value):
+    """Get a key that sorts values like SQLite does: NULL, numbers, text, then BLOBs."""
+    if value is None:
+        return 0, 0
+    elif isinstance(value, (int, float)):
+        return 1, value
+    elif isinstance(value, str):
+        return 2, value
+    return 3, value
+
+
+SUMMARIES = {
+    "app_duration": Summary(
+        "app_duration",
+        "Activities and total activeDurationSeconds per application.",
+        [("Application", APPLICATION_SQL)],
+        [
+            ("Activities", "COUNT(*)", "sum"),
+            ("ActiveDurationSeconds", "SUM({})".format(ACTIVE_DURATION_SQL), "sum")
+        ]
+    ),
+    "daily": Summary(
+        "daily",
+        "Activities and total activeDurationSeconds per day (UTC StartTime), per user.",
+        [("Day", "date(StartTime, 'unixepoch')")],
+        [
+            ("Activities", "COUNT(*)", "sum"),
+            ("ActiveDurationSeconds", "SUM({})".format(ACTIVE_DURATION_SQL), "sum")
+        ],
+        extra_keys=("_source", "_user")
+    ),
+    "app_activity": Summary(
+        "app_activity",
+        "First StartTime, last LastModifiedTime and activities per AppActivityId.",
+        [("AppActivityId", "AppActivityId")],
+        [
+            ("Application", "MIN({})".format(APPLICATION_SQL), "min"),
+            ("Activities", "COUNT(*)", "sum"),
+            ("FirstSeen", "MIN(StartTime)", "min"),
+            ("LastSeen", "MAX(LastModifiedTime)", "max")
+        ],
+        time_columns=("FirstSeen", "LastSeen")
+    )
+}
+
+
+def iter_keyed_rows(summary, rows, extra=None):
+    """Key the rows of a summary query to merge them.
+
+    Params:
+        summary (Summary): The summary of the rows.
+        rows (iterator): Row dicts in query order.
+        extra (dict): Extra fields of the source, the extra_keys of the summary are
+            added to each row.
+    Yields:
+        (tuple): (merge key, row)
+    """
+    extra_fields = {}
+    if extra:
+        extra_fields = dict(
+            (name, extra[name]) for name in summary.extra_keys if name in extra
+        )
+
+    for row in rows:
+        if extra_fields:
+            row = dict(extra_fields, **row)
+        yield summary.get_row_key(row), row
+
+
+def iter_merged_rows(summary, streams):
+    """Merge keyed summary rows of several databases. The streams are in key order,
+    so rows with the same key are next to each other after merge_sorted and only one
+    row is held at a time.
+
+    Params:
+        summary (Summary): The summary of the rows.
+        streams (list): Iterables of (merge key, row), each in key order.
+    Yields:
+        (tuple): (merge key, merged row), in key order.
+    """
+    current_key = None
+    current_row = None
+    for key, row in merge_sorted(streams):
+        if current_row is not None and key == current_key:
+            summary.merge_rows(current_row, row)
+            continue
+
+        if current_row is not None:
+            yield current_key, current_row
+        current_key = key
+        current_row = dict(row)
+
+    if current_row is not None:
+        yield current_key, current_row
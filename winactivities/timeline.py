@@ -0,0 +1,135 @@
+import os
+import heapq
+import pickle
+import logging
+import tempfile
+
+# --sort value -> Activity column
+SORT_FIELDS = {
+    "starttime": "StartTime",
+    "lastmodifiedtime": "LastModifiedTime",
+    "endtime": "EndTime"
+}
+# the items sorted in memory before a run is spilled to disk
+DEFAULT_RUN_SIZE = 100000
+
+
+def get_sort_key(value):
+    """Get the merge key of a sort column value. NULL sorts first, as in SQLite."""
+    if value is None:
+        return -1
+    return value
+
+
+def _get_item_key(keyed_item):
+    return keyed_item[0]
+
+
+def merge_sorted(streams):
+    """Merge streams that are each ordered by key into one ordered stream. Only the
+    next item of each stream is held, so memory depends on the number of streams and
+    not on the number of items.
+
+    Params:
+        streams (list): Iterables of keyed items, tuples starting with the sort key,
+            each in key order.
+    Returns:
+        (iterator): The keyed items in key order, equal keys in stream order.
+    """
+    return heapq.merge(*streams, key=_get_item_key)
+
+
+class ExternalSorter(object):
+    """Sorts keyed items (tuples starting with the sort key) that are not in order,
+    with bounded memory.
+
+    Items are gathered into runs that are sorted in memory. When there is more
+    than one run, each run is pickled to a temp file and the runs are merged.
+    """
+    def __init__(self, temp_location=None, run_size=DEFAULT_RUN_SIZE):
+        """Create ExternalSorter
+
+        Params:
+            temp_location (unicode): The folder to spill runs to. None = the system temp folder.
+            run_size (int): The number of items to sort in memory at a time.
+        """
+        self.temp_location = temp_location
+        self.run_size = run_size
+        self._run = []
+        self._run_locations = []
+
+    def add(self, keyed_item):
+        self._run.append(keyed_item)
+        if len(self._run) >= self.run_size:
+            self._spill()
+
+    def _spill(self):
+        self._run.sort(key=_get_item_key)
+        if self.temp_location and not os.path.isdir(self.temp_location):
+            # nothing was extracted to the temp folder when reading into memory
+            os.makedirs(self.temp_location, exist_ok=True)
+        run_handle, run_location = tempfile.mkstemp(
+            prefix="win-activities-run-", suffix=".pickle", dir=self.temp_location
+        )
+        with os.fdopen(run_handle, "wb") as fh:
+            # one pickler per run, so shared objects such as record layouts are stored once
+            pickler = pickle.Pickler(fh, pickle.HIGHEST_PROTOCOL)
+            for keyed_item in self._run:
+                pickler.dump(keyed_item)
+
+        logging.debug("Spilled {} items to {}".format(len(self._run), run_location))
+        self._run_locations.append(run_location)
+        self._run = []
+
+    @staticmethod
+    def _iter_run(run_location):
+        with open(run_location, "rb") as fh:
+            unpickler = pickle.Unpickler(fh)
+            while True:
+                try:
+                    yield unpickler.load()
+                except EOFError:
+                    return
+
+    def __iter__(self):
+        """Iterate the keyed items in key order. The temp files are removed
+        when the iteration ends."""
+        if not self._run_locations:
+            self._run.sort(key=_get_item_key)
+            run = self._run
+            self._run = []
+            for keyed_item in run:
+                yield keyed_item
+            return
+
+        if self._run:
+            self._spill()
+
+        try:
+            runs = [self._iter_run(run_location) for run_location in self._run_locations]
+            for keyed_item in merge_sorted(runs):
+                yield keyed_item
+        finally:
+            for run_location in self._run_locations:
+                os.remove(run_location)
+            self._run_locations = []
+
+
+def iter_external_sorted(keyed_items, temp_location=None, run_size=DEFAULT_RUN_SIZE):
+    """Sort keyed items that are not in key order, spilling to temp files when there
+    are more than run_size of them."""
+    sorter = ExternalSorter(temp_location, run_size)
+    for keyed_item in keyed_items:
+        sorter.add(keyed_item)
+    for keyed_item in sorter:
+        yield keyed_item
+
+
+def iter_keyed_records(records):
+    """Key the (record, extra) tuples of activities selected with a sort_field.
+
+    Yields:
+        (tuple): (sort key, record, extra)
+    """
+    for record, extra in records:
+        yield get_sort_key(record["_sort_key"]), record, extra
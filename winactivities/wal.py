@@ -0,0 +1,302 @@
+import mmap
+import struct
+import logging
+
+WAL_HEADER_SIZE = 32
+WAL_FRAME_HEADER_SIZE = 24
+WAL_MAGIC_LE = 0x377f0682
+WAL_MAGIC_BE = 0x377f0683
+# index and table interior b-tree pages, the pages with child page pointers
+BTREE_INTERIOR_PAGE_TYPES = (0x02, 0x05)
+
+
+class WalFrame(object):
+    """A frame (page version) in a SQLite write-ahead log."""
+    __slots__ = ("number", "offset", "page_number", "db_size")
+
+    def __init__(self, number, offset, page_number, db_size):
+        """Create WalFrame
+
+        Params:
+            number (int): The index of the frame in the WAL.
+            offset (int): The offset of the page data in the WAL.
+            page_number (int): The database page the frame is a version of.
+            db_size (int): The database size in pages after a commit, 0 = not a commit frame.
+        """
+        self.number = number
+        self.offset = offset
+        self.page_number = page_number
+        self.db_size = db_size
+
+    @property
+    def is_commit(self):
+        return self.db_size != 0
+
+
+def wal_checksum(data, s0, s1, byte_order):
+    """The cumulative checksum SQLite uses for WAL headers and frames."""
+    words = struct.unpack(
+        "{}{}I".format(byte_order, len(data) // 4), data
+    )
+    for i in range(0, len(words), 2):
+        s0 = (s0 + words[i] + s1) & 0xFFFFFFFF
+        s1 = (s1 + words[i + 1] + s0) & 0xFFFFFFFF
+    return s0, s1
+
+
+class WalIndex(object):
+    """An index of the committed frames of a SQLite WAL file.
+
+    The frame headers are parsed once. Frames are valid while their salts match
+    the WAL header and the running checksum holds, and only the frames up to the
+    last valid commit are part of the database. The database can then be read
+    at its latest state, or at any earlier commit, by applying the indexed
+    frames to an image of the database file without a checkpoint.
+    """
+    def __init__(self, data, verify_checksums=True):
+        """Create WalIndex
+
+        Params:
+            data (bytes): The WAL file contents (bytes, or a mmap of the file).
+            verify_checksums (bool): True = Stop at the first frame with a bad checksum.
+        """
+        self._data = data
+        self.frames = []
+        self.commits = []
+        self.page_index = {}
+        self.page_size = 0
+        self.checkpoint_sequence = None
+
+        if len(data) < WAL_HEADER_SIZE:
+            return
+
+        magic, version, page_size, checkpoint_sequence, salt1, salt2, checksum1, checksum2 = struct.unpack(
+            ">8I", data[:WAL_HEADER_SIZE]
+        )
+        if magic not in (WAL_MAGIC_LE, WAL_MAGIC_BE):
+            logging.warning("Not a WAL file, bad magic: {:#x}".format(magic))
+            return
+
+        byte_order = ">" if magic == WAL_MAGIC_BE else "<"
+        if verify_checksums:
+            if wal_checksum(data[:24], 0, 0, byte_order) != (checksum1, checksum2):
+                logging.warning("WAL header checksum does not match, no frames are used.")
+                return
+
+        self.page_size = page_size
+        self.checkpoint_sequence = checkpoint_sequence
+
+        s0, s1 = checksum1, checksum2
+        frame_size = WAL_FRAME_HEADER_SIZE + page_size
+        offset = WAL_HEADER_SIZE
+        frames = []
+        committed_count = 0
+        while offset + frame_size <= len(data):
+            page_number, db_size, frame_salt1, frame_salt2, frame_checksum1, frame_checksum2 = struct.unpack(
+                ">6I", data[offset:offset + WAL_FRAME_HEADER_SIZE]
+            )
+            if (frame_salt1, frame_salt2) != (salt1, salt2):
+                break
+
+            if verify_checksums:
+                s0, s1 = wal_checksum(data[offset:offset + 8], s0, s1, byte_order)
+                s0, s1 = wal_checksum(
+                    data[offset + WAL_FRAME_HEADER_SIZE:offset + frame_size], s0, s1, byte_order
+                )
+                if (s0, s1) != (frame_checksum1, frame_checksum2):
+                    break
+
+            frame = WalFrame(
+                len(frames), offset + WAL_FRAME_HEADER_SIZE, page_number, db_size
+            )
+            frames.append(frame)
+            if frame.is_commit:
+                committed_count = len(frames)
+                self.commits.append(frame.number)
+
+            offset += frame_size
+
+        # frames after the last commit are not part of the database
+        self.frames = frames[:committed_count]
+
+        self.page_index = self.get_page_index()
+
+    @classmethod
+    def from_file(cls, location, verify_checksums=True):
+        """Create a WalIndex over a memory map of a WAL file."""
+        with open(location, "rb") as fh:
+            try:
+                data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                data = b""
+
+        return cls(data, verify_checksums=verify_checksums)
+
+    def get_page_index(self, commit=None):
+        """Get the latest frame of each page at a commit.
+
+        Params:
+            commit (int): The number of commits to include. None = all commits.
+        Returns:
+            (dict): page number -> WalFrame
+        """
+        page_index = {}
+        for frame in self._iter_commit_frames(0, commit):
+            page_index[frame.page_number] = frame
+        return page_index
+
+    def get_page(self, page_number):
+        """Get the latest committed version of a page, None if it is not in the WAL."""
+        frame = self.page_index.get(page_number)
+        if frame is None:
+            return None
+        return self.get_frame_data(frame)
+
+    def get_frame_data(self, frame):
+        return bytes(self._data[frame.offset:frame.offset + self.page_size])
+
+    def iter_superseded_frames(self):
+        """Iterate the committed frames that a later frame replaced, the older page versions."""
+        for frame in self.frames:
+            if self.page_index[frame.page_number] is not frame:
+                yield frame
+
+    def get_commit_pages(self, commit):
+        """Get the page numbers that a commit wrote.
+
+        Params:
+            commit (int): The commit, 1 = the first commit of the WAL.
+        Returns:
+            (set): The page numbers.
+        """
+        return set(frame.page_number for frame in self._iter_commit_frames(commit - 1, commit))
+
+    def _iter_commit_frames(self, start_commit, end_commit):
+        """Iterate the frames of the commits after start_commit up to end_commit."""
+        if end_commit is None:
+            end_commit = len(self.commits)
+        if end_commit <= start_commit:
+            return
+
+        first_frame = 0
+        if start_commit > 0:
+            first_frame = self.commits[start_commit - 1] + 1
+        last_frame = self.commits[end_commit - 1]
+
+        for frame in self.frames[first_frame:last_frame + 1]:
+            yield frame
+
+    def _apply_frames(self, image, frames):
+        db_size = None
+        for frame in frames:
+            start = (frame.page_number - 1) * self.page_size
+            if len(image) < start:
+                image.extend(bytes(start - len(image)))
+            image[start:start + self.page_size] = self._data[frame.offset:frame.offset + self.page_size]
+            if frame.is_commit:
+                db_size = frame.db_size
+
+        if db_size is not None:
+            # the database size after the commit, pages past it were truncated
+            del image[db_size * self.page_size:]
+
+        # mark the image as a rollback journal database so it can be opened
+        # without its WAL
+        image[18:20] = b"\x01\x01"
+
+    def get_image(self, db_data, commit=None):
+        """Get the database contents at a commit.
+
+        Params:
+            db_data (bytes): The database file contents.
+            commit (int): The number of WAL commits to apply, 0 = the database file only.
+                None = all commits.
+        Returns:
+            (bytearray): The database image.
+        """
+        image = bytearray(db_data)
+        self._apply_frames(
+            image, self._iter_commit_frames(0, commit)
+        )
+        return image
+
+    def iter_images(self, db_data):
+        """Iterate the database contents at every commit, starting with the database file.
+
+        The same image is patched in place from one commit to the next, so it must
+        be used before the next one is requested.
+
+        Yields:
+            (tuple): (number of commits applied, bytearray image)
+        """
+        image = bytearray(db_data)
+        self._apply_frames(image, [])
+        yield 0, image
+
+        for commit in range(1, len(self.commits) + 1):
+            self._apply_frames(
+                image, self._iter_commit_frames(commit - 1, commit)
+            )
+            yield commit, image
+
+
+def get_page_size(image):
+    """Get the page size from the header of a database image."""
+    page_size = struct.unpack(">H", image[16:18])[0]
+    if page_size == 1:
+        return 65536
+    return page_size
+
+
+def get_btree_pages(image, page_size, root_page):
+    """Get the interior and leaf pages of a b-tree in a database image. Overflow pages
+    are left out, a change to a row always writes its leaf page too.
+
+    Params:
+        image (bytes): The database image.
+        page_size (int): The page size of the database.
+        root_page (int): The root page number of the table or index.
+    Returns:
+        (set): The page numbers.
+    """
+    pages = set()
+    page_numbers = [root_page]
+    while page_numbers:
+        page_number = page_numbers.pop()
+        page_start = (page_number - 1) * page_size
+        if page_number < 1 or page_number in pages or page_start + page_size > len(image):
+            continue
+
+        pages.add(page_number)
+        # page 1 starts with the database header
+        header = page_start + (100 if page_number == 1 else 0)
+        if image[header] not in BTREE_INTERIOR_PAGE_TYPES:
+            continue
+
+        cell_count, = struct.unpack(">H", image[header + 3:header + 5])
+        right_page, = struct.unpack(">I", image[header + 8:header + 12])
+        page_numbers.append(right_page)
+        for index in range(cell_count):
+            pointer = header + 12 + index * 2
+            cell_offset, = struct.unpack(">H", image[pointer:pointer + 2])
+            cell = page_start + cell_offset
+            child_page, = struct.unpack(">I", image[cell:cell + 4])
+            page_numbers.append(child_page)
+
+    return pages
+
+
+def get_database_image(db_data, wal_data=None, commit=None):
+    """Get the contents of a database with the committed frames of its WAL applied, to
+    open in memory with DbHandler(image=...). The image is marked as a rollback journal
+    database even without a WAL, SQLite cannot open a WAL mode image in memory.
+
+    Params:
+        db_data (bytes): The database file contents.
+        wal_data (bytes): The WAL file contents, None = no WAL.
+        commit (int): The number of WAL commits to apply, None = all commits.
+    Returns:
+        (bytearray): The database image.
+    """
+    return WalIndex(wal_data or b"").get_image(db_data, commit)